@@ -1,25 +1,209 @@
+import copy
+import hashlib
 import os
 import time
 
+import numpy as np
 import torch
 import torchvision.models as models
 import torchvision.transforms as transforms
-from torch.utils.data import DataLoader, random_split
-from torchinfo import summary
+import ujson
+from checkpointWriter import CheckpointWriter
+from distributedTraining import (
+    all_reduce_sum,
+    barrier,
+    get_rank,
+    get_world_size,
+    init_distributed,
+    is_distributed,
+    is_main_process,
+    print_main,
+)
+from featureStore import FeatureStore
+from imageGenerator import CATEGORY, colorize, compile_color_map
+from metrics import metrics
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import DataLoader, Dataset, Subset, random_split
+from torch.utils.data.distributed import DistributedSampler
 from torchvision.datasets import ImageFolder
 from tqdm.auto import tqdm
 
+# features[:FROZEN_LAYERS] are frozen while fine-tuning
+FROZEN_LAYERS = 24
+
+# shape of a sample in each input mode
+INPUT_SIZE = {
+    "image": (3, 224, 224),
+    "compact": (3, 16, 16),
+    "counts": (16, len(CATEGORY)),
+}
+
+
+class PackedFeatureDataset(Dataset):
+    """
+    Samples of a FeatureStore, in one of the input modes:
+    image: rendered the same as the generated 224x224 images
+    compact: colorized 16x16 images, before the resize
+    counts: the raw feature arrays
+    """
+
+    def __init__(self, store_dir, color_map, families=None, input_mode="image"):
+        self.store = FeatureStore(store_dir)
+        self.input_mode = input_mode
+        samples = [
+            (name, label)
+            for name, label in self.store.get_samples()
+            if label and (families is None or label in families)
+        ]
+        # classes and samples are sorted like ImageFolder does with the images
+        self.classes = sorted({label for _, label in samples})
+        self.class_to_idx = {label: i for i, label in enumerate(self.classes)}
+        self.samples = sorted(
+            ((name, self.class_to_idx[label]) for name, label in samples),
+            key=lambda sample: (sample[1], sample[0]),
+        )
+        self.targets = [target for _, target in self.samples]
+        self.color_thresholds, self.color_table = compile_color_map(color_map, CATEGORY)
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __getitem__(self, index):
+        name, target = self.samples[index]
+        # read straight from the memory-mapped shard
+        feature_array = self.store.get_feature_array(name)
+        if self.input_mode == "counts":
+            return torch.tensor(feature_array, dtype=torch.float32), target
+        image = colorize(feature_array, self.color_thresholds, self.color_table)
+        if self.input_mode == "image":
+            image = np.repeat(np.repeat(image, 14, axis=0), 14, axis=1)
+        # the images are written by OpenCV as BGR and read back as RGB
+        image = np.ascontiguousarray(image[..., ::-1].transpose(2, 0, 1))
+        return torch.from_numpy(image).float().div_(255), target
+
+
+class CachedActivationDataset(Dataset):
+    """
+    Activations of the frozen layers, memory-mapped from the activation cache.
+    """
+
+    def __init__(self, activations, targets):
+        self.activations = activations
+        self.targets = targets
+
+    def __len__(self):
+        return len(self.targets)
+
+    def __getitem__(self, index):
+        activation = torch.from_numpy(np.array(self.activations[index]))
+        return activation.float(), self.targets[index]
+
+
+class InputExpansion(torch.nn.Module):
+    """
+    Expand a batch of compact inputs to the 224x224 images VGG16 takes, on
+    the device: colorize raw counts with the color map, then resize 14 times
+    with nearest neighbor, the same as the generated images.
+    """
+
+    def __init__(self, input_mode, color_map=None):
+        super().__init__()
+        self.input_mode = input_mode
+        if input_mode == "counts":
+            thresholds, colors = compile_color_map(color_map, CATEGORY)
+            # the images are written by OpenCV as BGR and read back as RGB
+            colors = colors[..., ::-1] / 255
+            self.register_buffer(
+                "thresholds", torch.tensor(thresholds, dtype=torch.float32)
+            )
+            self.register_buffer("colors", torch.tensor(colors, dtype=torch.float32))
+
+    def forward(self, x):
+        if self.input_mode == "image":
+            return x
+        if self.input_mode == "counts":
+            # count the thresholds each count exceeds, then gather the color
+            index = (x.unsqueeze(-1) > self.thresholds).sum(dim=-1)
+            categories = torch.arange(self.colors.shape[0], device=x.device)
+            x = self.colors[categories, index].permute(0, 3, 1, 2)
+        return torch.nn.functional.interpolate(x, scale_factor=14, mode="nearest")
+
 
 class VGG16:
-    def __init__(self, batch_size, learning_rate):
+    def __init__(
+        self,
+        batch_size,
+        learning_rate,
+        input_mode="image",
+        num_workers=0,
+        pin_memory=None,
+        prefetch_factor=None,
+        persistent_workers=False,
+        precision="fp32",
+        channels_last=False,
+        compile=False,
+        checkpoint_mode="full",
+        keep_last=None,
+        keep_best=0,
+        model_cache=None,
+        model_summary=False,
+        distributed=False,
+    ):
         self.batch_size = batch_size
         self.learning_rate = learning_rate
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        # data-parallel training over the processes launched by torchrun, a
+        # single process trains as usual
+        if distributed:
+            init_distributed()
+        self.distributed = distributed and is_distributed()
+        if self.distributed and self.device.type == "cuda":
+            self.device = torch.device("cuda", int(os.environ.get("LOCAL_RANK", 0)))
+        # "image", or "compact"/"counts" to load 16x16 inputs from a feature
+        # store and expand them to 224x224 on the device
+        self.input_mode = input_mode
+        self.color_map = None
+        # data loader settings, num_workers "auto" sizes it by the free cores
+        # and pin_memory None pins when training on GPU
+        if num_workers == "auto":
+            num_workers = min(len(os.sched_getaffinity(0)) - 1, 8)
+        self.num_workers = max(0, num_workers)
+        self.pin_memory = (
+            self.device.type == "cuda" if pin_memory is None else pin_memory
+        )
+        self.prefetch_factor = prefetch_factor
+        self.persistent_workers = persistent_workers
+        # execution mode: "fp32" or "bf16" autocast, channels_last memory
+        # format, and torch.compile of the network
+        self.precision = precision
+        self.channels_last = channels_last
+        self.compile = compile
+        self.compiled_network = None
+        # checkpoints: "full" state dict, or "lean" with only the trained
+        # parameters and a reference to the base weights; keep the keep_last
+        # newest (None for all) and the keep_best most accurate epochs
+        self.checkpoint_mode = checkpoint_mode
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        self.checkpoint_writer = None
+        # directory caching the customized pretrained model, memory-mapped
+        # on load, or None; and whether loadModel prints a model summary
+        self.model_cache = model_cache
+        self.model_summary = model_summary
 
-    def loadData(self, input_path):
+    def loadData(self, input_path, color_map=None, families=None):
         """
-        Load data from input path.
+        Load data from input path, either a folder of images per family or a
+        feature store, which also needs the color map.
         """
+        self.color_map = color_map
+        if FeatureStore.exists(input_path):
+            self.input_data = PackedFeatureDataset(
+                input_path, color_map, families, self.input_mode
+            )
+            return
+        if self.input_mode != "image":
+            raise ValueError(f"Input mode {self.input_mode} needs a feature store.")
         tf = transforms.Compose([transforms.ToTensor()])
         self.input_data = ImageFolder(input_path, transform=tf)
 
@@ -29,41 +213,82 @@ class VGG16:
         """
         train_size = int(train_ratio * len(self.input_data))
         val_size = len(self.input_data) - train_size
-        train_data, valid_data = random_split(self.input_data, [train_size, val_size])
+        # every process must draw the same split
+        split = {"generator": torch.Generator().manual_seed(0)}
+        self.train_data, self.valid_data = random_split(
+            self.input_data,
+            [train_size, val_size],
+            **(split if self.distributed else {}),
+        )
 
         # set data loader
-        self.train_loader = DataLoader(
-            train_data, batch_size=self.batch_size, shuffle=True
-        )
-        self.valid_loader = DataLoader(
-            valid_data, batch_size=self.batch_size, shuffle=True
-        )
+        self.train_loader = self.makeLoader(self.train_data, True, self.distributed)
+        self.valid_loader = self.makeLoader(self.valid_data, False, self.distributed)
 
     def setValidationData(self):
         """
         Set validation data.
         """
-        self.valid_loader = DataLoader(
-            self.input_data, batch_size=self.batch_size, shuffle=True
+        self.valid_data = self.input_data
+        self.valid_loader = self.makeLoader(self.valid_data, False, self.distributed)
+
+    def makeLoader(self, data, shuffle, distributed=False):
+        """
+        Make a data loader with the loader settings.
+
+        With distributed, each process only loads its part of the data: a
+        new shuffle of it every epoch (see DistributedSampler.set_epoch) or,
+        without shuffle, every world size-th sample, so that no sample is
+        counted twice when validating.
+        """
+        # prefetching and persistent workers only apply to worker processes
+        workers = {}
+        if self.num_workers > 0:
+            workers = {
+                "prefetch_factor": self.prefetch_factor,
+                "persistent_workers": self.persistent_workers,
+            }
+        sampler = None
+        if distributed and shuffle:
+            sampler = DistributedSampler(data, shuffle=True)
+            shuffle = False
+        elif distributed:
+            data = self.shardData(data)
+        return DataLoader(
+            data,
+            batch_size=self.batch_size,
+            shuffle=shuffle,
+            sampler=sampler,
+            num_workers=self.num_workers,
+            pin_memory=self.pin_memory,
+            **workers,
         )
 
+    def shardData(self, data):
+        """
+        Get the samples of this process, every world size-th one.
+        """
+        rank, world_size = get_rank(), get_world_size()
+        if isinstance(data, Subset):
+            return Subset(data.dataset, data.indices[rank::world_size])
+        return Subset(data, range(rank, len(data), world_size))
+
     def loadModel(self, pretrained: str = None):
         """
         Load VGG16 model.
         """
-        # set model
-        self.model = models.vgg16(weights=models.VGG16_Weights.DEFAULT).to(self.device)
-
-        # fine tune: customize model classifier
-        self.model.classifier[0] = torch.nn.Linear(
-            in_features=25088, out_features=2048, bias=True
-        )
-        self.model.classifier[3] = torch.nn.Linear(
-            in_features=2048, out_features=2048, bias=True
-        )
-        self.model.classifier[6] = torch.nn.Linear(
-            in_features=2048, out_features=25, bias=True
+        # set model, the base weights are what lean checkpoints refer to
+        self.base_weights = str(models.VGG16_Weights.DEFAULT)
+        self.model = self.loadBaseModel(initialize=pretrained is None)
+        self.model.to(self.device)
+        # expand the compact inputs in the forward pass, the state dict of
+        # self.model stays the same in every input mode
+        self.input_expansion = InputExpansion(self.input_mode, self.color_map)
+        self.network = torch.nn.Sequential(self.input_expansion, self.model).to(
+            self.device
         )
+        if self.channels_last:
+            self.network.to(memory_format=torch.channels_last)
 
         # frozen layers, set requires_grad to False, so that the parameters will not be updated during training
         for param in self.model.parameters():
@@ -83,13 +308,287 @@ class VGG16:
 
         # load pretrained model
         if pretrained is not None:
-            checkpoint = torch.load(pretrained)
-            self.model.load_state_dict(checkpoint["model_state_dict"])
-            self.optimizer.load_state_dict(checkpoint["optimizer_state_dict"])
-            self.criterion.load_state_dict(checkpoint["loss"])
-            self.model.eval()
+            self.loadCheckpoint(pretrained)
+
+        if self.model_summary:
+            self.printSummary()
+        self.wrapNetwork()
+
+    def wrapNetwork(self):
+        """
+        Average the gradients of the network over the processes, when
+        distributed. The weights of rank 0 are copied to the others.
+        """
+        if not self.distributed:
+            return
+        device_ids = [self.device] if self.device.type == "cuda" else None
+        self.network = DistributedDataParallel(self.network, device_ids=device_ids)
+
+    def buildModel(self, weights=None):
+        """
+        Build VGG16 with the customized classifier.
+        """
+        model = models.vgg16(weights=weights)
 
-        summary(self.model, input_size=(self.batch_size, 3, 224, 224))
+        # fine tune: customize model classifier
+        model.classifier[0] = torch.nn.Linear(
+            in_features=25088, out_features=2048, bias=True
+        )
+        model.classifier[3] = torch.nn.Linear(
+            in_features=2048, out_features=2048, bias=True
+        )
+        model.classifier[6] = torch.nn.Linear(
+            in_features=2048, out_features=25, bias=True
+        )
+        return model
+
+    def loadBaseModel(self, initialize=True):
+        """
+        Load the pretrained VGG16 with the customized classifier, from the
+        model cache if it is there.
+
+        A cached model is built on the meta device and gets the cached
+        weights memory-mapped, so nothing is initialized nor copied. With
+        initialize, the customized layers are initialized again, as they
+        would be without the cache; leave it off when loading a checkpoint.
+        """
+        if self.model_cache is None:
+            return self.buildModel(models.VGG16_Weights.DEFAULT)
+        cache_path = os.path.join(self.model_cache, f"{self.base_weights}.pt")
+        if not os.path.exists(cache_path):
+            model = self.buildModel(models.VGG16_Weights.DEFAULT)
+            os.makedirs(self.model_cache, exist_ok=True)
+            # replace the file at once, so a crash never leaves half of it,
+            # from each process under its own name
+            part_path = f"{cache_path}.{os.getpid()}.part"
+            torch.save(model.state_dict(), part_path)
+            os.replace(part_path, cache_path)
+            return model
+        with torch.device("meta"):
+            model = self.buildModel()
+        state_dict = torch.load(cache_path, mmap=True, weights_only=True)
+        model.load_state_dict(state_dict, assign=True)
+        if initialize:
+            for i in (0, 3, 6):
+                model.classifier[i].reset_parameters()
+        return model
+
+    def printSummary(self):
+        """
+        Print the summary of the network, with a forward pass of a batch.
+        """
+        from torchinfo import summary
+
+        training = self.model.training
+        summary(
+            self.network,
+            input_size=(self.batch_size, *INPUT_SIZE[self.input_mode]),
+            verbose=int(is_main_process()),
+        )
+        # the summary sets the mode of the whole network back, the model
+        # included, so keep it in evaluation mode after loading a checkpoint
+        self.model.train(training)
+
+    def loadCheckpoint(self, pretrained):
+        """
+        Load a full or a lean checkpoint into the model.
+        """
+        checkpoint = torch.load(pretrained, map_location=self.device, mmap=True)
+        lean = checkpoint.get("lean", False)
+        if lean and checkpoint.get("base_weights") != self.base_weights:
+            print(
+                "Warning: the checkpoint was trained from %s, not %s."
+                % (checkpoint.get("base_weights"), self.base_weights)
+            )
+        # a lean checkpoint only has the trained parameters, the rest are
+        # the base weights already loaded
+        missing, _ = self.model.load_state_dict(
+            checkpoint["model_state_dict"], strict=not lean
+        )
+        missing = set(missing) & self.getTrainedKeys()
+        if missing:
+            raise ValueError(f"The checkpoint misses trained parameters: {missing}")
+        self.optimizer.load_state_dict(checkpoint["optimizer_state_dict"])
+        self.criterion.load_state_dict(checkpoint["loss"])
+        self.model.eval()
+
+    def getTrainedKeys(self):
+        """
+        Get the state dict keys changed by training: the parameters that
+        are not frozen, and the buffers.
+        """
+        params = dict(self.model.named_parameters())
+        return {
+            key
+            for key in self.model.state_dict()
+            if key not in params or params[key].requires_grad
+        }
+
+    def getCacheKey(self):
+        """
+        Get a key of what the frozen activations depend on: the samples, the
+        input mode and color map, and the frozen weights.
+        """
+        key = hashlib.sha256()
+        key.update(self.input_mode.encode())
+        if isinstance(self.input_data, PackedFeatureDataset):
+            stat = os.stat(self.input_data.store.index_path)
+            key.update(f"{stat.st_size}:{stat.st_mtime_ns}".encode())
+            samples = self.input_data.samples
+        else:
+            samples = [
+                (path, target, os.stat(path).st_size, os.stat(path).st_mtime_ns)
+                for path, target in self.input_data.samples
+            ]
+        key.update(ujson.dumps(samples).encode())
+        if self.color_map is not None:
+            with open(self.color_map, "rb") as f:
+                key.update(f.read())
+        for name, tensor in self.model.features[:FROZEN_LAYERS].state_dict().items():
+            key.update(name.encode())
+            key.update(tensor.cpu().numpy().tobytes())
+        return key.hexdigest()
+
+    def cacheActivations(self, cache_dir, dtype="float32"):
+        """
+        Run the frozen layers once over the dataset and cache their
+        activations, then train and validate only the layers after them.
+
+        The cache is rebuilt when the samples, the input mode or color map,
+        or the frozen weights change. When distributed, rank 0 builds it.
+        """
+        os.makedirs(cache_dir, exist_ok=True)
+        cache_path = os.path.join(cache_dir, "activations.npy")
+        meta_path = os.path.join(cache_dir, "meta.json")
+        key = self.getCacheKey()
+        meta = {}
+        if os.path.exists(meta_path):
+            with open(meta_path, "r") as f:
+                meta = ujson.load(f)
+        rebuild = meta.get("key") != key or not os.path.exists(cache_path)
+        if rebuild and is_main_process():
+            print_main("Caching the activations of the frozen layers.")
+            frozen = torch.nn.Sequential(
+                self.input_expansion, self.model.features[:FROZEN_LAYERS]
+            ).eval()
+            activations = None
+            row = 0
+            with torch.no_grad():
+                for x, _ in tqdm(self.makeLoader(self.input_data, False), ncols=50):
+                    output = frozen(x.to(self.device)).cpu().numpy()
+                    if activations is None:
+                        activations = np.lib.format.open_memmap(
+                            cache_path + ".part",
+                            mode="w+",
+                            dtype=dtype,
+                            shape=(len(self.input_data), *output.shape[1:]),
+                        )
+                    activations[row : row + len(output)] = output
+                    row += len(output)
+            activations.flush()
+            del activations
+            os.replace(cache_path + ".part", cache_path)
+            with open(meta_path, "w") as f:
+                ujson.dump({"key": key}, f)
+        barrier()
+        cached_data = CachedActivationDataset(
+            np.load(cache_path, mmap_mode="r"), list(self.input_data.targets)
+        )
+
+        # use the cache in place of the samples, keeping the same split
+        def cached(data):
+            if isinstance(data, Subset):
+                return Subset(cached_data, data.indices)
+            return cached_data
+
+        if hasattr(self, "train_data"):
+            self.train_loader = self.makeLoader(
+                cached(self.train_data), True, self.distributed
+            )
+        if hasattr(self, "valid_data"):
+            self.valid_loader = self.makeLoader(
+                cached(self.valid_data), False, self.distributed
+            )
+        # from now on the network starts right after the frozen layers
+        self.network = torch.nn.Sequential(
+            self.model.features[FROZEN_LAYERS:],
+            self.model.avgpool,
+            torch.nn.Flatten(1),
+            self.model.classifier,
+        )
+        self.wrapNetwork()
+
+    def forward(self, x):
+        """
+        Forward pass of the network in the execution mode, return fp32 outputs.
+        """
+        network = self.network
+        if self.compile:
+            # compile again if the network was replaced, e.g. by the cache
+            if getattr(self.compiled_network, "_orig_mod", None) is not network:
+                self.compiled_network = torch.compile(network)
+            network = self.compiled_network
+        if self.channels_last and x.dim() == 4:
+            x = x.contiguous(memory_format=torch.channels_last)
+        with torch.autocast(
+            self.device.type,
+            dtype=torch.bfloat16,
+            enabled=self.precision == "bf16",
+        ):
+            return network(x).float()
+
+    def checkExecutionMode(self, tolerance=0.01, x=None, log_path=None):
+        """
+        Compare the execution mode with the fp32 eager baseline, and fall back
+        to the baseline for the rest of the run if they differ by more than
+        tolerance: in validation accuracy, or without labels, in the share of
+        the samples of x whose predicted class changes.
+
+        The outcome goes to the metrics and to log_path.
+        """
+        mode = (self.precision, self.channels_last, self.compile)
+        if mode == ("fp32", False, False):
+            return True
+        print_main("Checking the execution mode against the fp32 baseline.")
+
+        def measure():
+            if x is None:
+                return self.validateModel()[0]
+            with torch.inference_mode():
+                return self.forward(x.to(self.device)).argmax(dim=1)
+
+        result = measure()
+        self.precision, self.channels_last, self.compile = "fp32", False, False
+        self.network.to(memory_format=torch.contiguous_format)
+        baseline = measure()
+        if x is None:
+            difference = abs(result - baseline)
+        else:
+            difference = (result != baseline).float().mean().item()
+        fallback = difference > tolerance
+        if fallback:
+            message = "Execution mode %s differs from fp32 by %.3f, falling back."
+        else:
+            message = "Execution mode %s matches fp32 within %.3f."
+            self.precision, self.channels_last, self.compile = mode
+            if self.channels_last:
+                self.network.to(memory_format=torch.channels_last)
+        message %= ("precision=%s, channels_last=%s, compile=%s" % mode, difference)
+        print_main(message)
+        metrics.set("execution_mode_fallback", int(fallback))
+        metrics.log(
+            "execution_mode",
+            precision=mode[0],
+            channels_last=mode[1],
+            compile=mode[2],
+            difference=difference,
+            fallback=fallback,
+        )
+        metrics.write()
+        if log_path is not None:
+            with open(log_path, "a") as f:
+                f.write(message + "\n\n")
+        return not fallback
 
     def trainModel(self, epochs, checkpoint_path: str = None, log_path=None):
         """
@@ -97,25 +596,39 @@ class VGG16:
         """
         train_losses, test_losses = [], []
         train_acc, test_acc = [], []
+        # only rank 0 writes the checkpoints and the log when distributed
+        if not is_main_process():
+            checkpoint_path, log_path = None, None
         if checkpoint_path is not None:
             os.makedirs(checkpoint_path, exist_ok=True)
+            self.checkpoint_writer = CheckpointWriter(self.keep_last, self.keep_best)
         for epoch in range(epochs):
             start_time = time.time()
             iter, iter2 = 0, 0  # iteration count, used to calculate the average loss
             correct_train, total_train = 0, 0
             correct_test, total_test = 0, 0
             train_loss, test_loss = 0.0, 0.0
+            data_time, compute_time = 0.0, 0.0  # time waiting for data / computing
 
             self.model.train()  # set the model to training mode
-            print("epoch: " + str(epoch + 1) + " / " + str(epochs))
+            print_main("epoch: " + str(epoch + 1) + " / " + str(epochs))
+            # shuffle the part of each process differently every epoch
+            if isinstance(self.train_loader.sampler, DistributedSampler):
+                self.train_loader.sampler.set_epoch(epoch)
 
             # ---------------------------
             # Training Stage
             # ---------------------------
-            for x, label in tqdm(self.train_loader, ncols=50):
-                x, label = x.to(self.device), label.to(self.device)
+            fetch_start = time.time()
+            for x, label in tqdm(
+                self.train_loader, ncols=50, disable=not is_main_process()
+            ):
+                compute_start = time.time()
+                data_time += compute_start - fetch_start
+                x = x.to(self.device, non_blocking=self.pin_memory)
+                label = label.to(self.device, non_blocking=self.pin_memory)
                 self.optimizer.zero_grad()  # clear the gradients of all optimized variables
-                train_output = self.model(
+                train_output = self.forward(
                     x
                 )  # forward pass: compute predicted outputs by passing inputs to the model
                 train_loss_c = self.criterion(
@@ -132,25 +645,32 @@ class VGG16:
                 correct_train += (predicted == label).sum()  # update the correct count
                 train_loss += train_loss_c.item()  # update the loss
                 iter += 1  # update the iteration count
+                fetch_start = time.time()
+                compute_time += fetch_start - compute_start
 
-            print(
+            # sum the counts of all the processes, when distributed
+            correct_train, total_train, train_loss, iter = all_reduce_sum(
+                torch.as_tensor(correct_train), total_train, train_loss, iter
+            )
+            print_main(
                 "Training acc: %.3f | loss: %.3f"
                 % (correct_train / total_train, train_loss / iter)
             )
 
-            if checkpoint_path is not None:
-                self.saveModel(
-                    epoch, checkpoint_path + "/epoch_" + str(epoch + 1) + ".pth"
-                )
-
             # --------------------------
             # Testing Stage
             # --------------------------
             self.model.eval()  # set the model to evaluation mode
-            for x, label in tqdm(self.valid_loader, ncols=50):
+            fetch_start = time.time()
+            for x, label in tqdm(
+                self.valid_loader, ncols=50, disable=not is_main_process()
+            ):
+                compute_start = time.time()
+                data_time += compute_start - fetch_start
                 with torch.no_grad():  # turn off gradients for evaluation
-                    x, label = x.to(self.device), label.to(self.device)
-                    test_output = self.model(
+                    x = x.to(self.device, non_blocking=self.pin_memory)
+                    label = label.to(self.device, non_blocking=self.pin_memory)
+                    test_output = self.forward(
                         x
                     )  # forward pass: compute predicted outputs by passing inputs to the model
                     test_loss_c = self.criterion(
@@ -163,12 +683,26 @@ class VGG16:
                     correct_test += (predicted == label).sum()
                     test_loss += test_loss_c.item()
                     iter2 += 1
+                fetch_start = time.time()
+                compute_time += fetch_start - compute_start
 
-            print(
+            correct_test, total_test, test_loss, iter2 = all_reduce_sum(
+                torch.as_tensor(correct_test), total_test, test_loss, iter2
+            )
+            print_main(
                 "Testing acc: %.3f | loss: %.3f"
                 % (correct_test / total_test, test_loss / iter2)
             )
 
+            # written in the background, the best epochs by testing accuracy
+            # are kept when rotating
+            if checkpoint_path is not None:
+                self.saveModel(
+                    epoch,
+                    checkpoint_path + "/epoch_" + str(epoch + 1) + ".pth",
+                    (correct_test / total_test).item(),
+                )
+
             train_acc.append(
                 100 * (correct_train / total_train).cpu()
             )  # training accuracy
@@ -176,8 +710,31 @@ class VGG16:
             train_losses.append((train_loss / iter))  # train loss
             test_losses.append((test_loss / iter2))  # test loss
 
+            # the data wait and compute times are the ones of this process,
+            # the samples per sec of all the processes
             end_time = time.time()
-            print("Cost %.3f(secs)" % (end_time - start_time))
+            print_main("Cost %.3f(secs)" % (end_time - start_time))
+            print_main(
+                "Data wait %.3f(secs) | compute %.3f(secs)" % (data_time, compute_time)
+            )
+            samples_per_sec = (total_train + total_test) / (end_time - start_time)
+            metrics.observe("train_epoch_seconds", end_time - start_time)
+            metrics.observe("train_data_wait_seconds", data_time)
+            metrics.observe("train_compute_seconds", compute_time)
+            metrics.set("train_samples_per_sec", samples_per_sec)
+            metrics.log(
+                "epoch",
+                epoch=epoch + 1,
+                train_acc=(correct_train / total_train).item(),
+                train_loss=train_loss / iter,
+                test_acc=(correct_test / total_test).item(),
+                test_loss=test_loss / iter2,
+                seconds=end_time - start_time,
+                data_wait=data_time,
+                compute=compute_time,
+                samples_per_sec=samples_per_sec,
+            )
+            metrics.write()
 
             if log_path is not None:
                 with open(log_path, "a") as f:
@@ -192,38 +749,70 @@ class VGG16:
                         % (correct_test / total_test, test_loss / iter2)
                         + "\n"
                     )
-                    f.write("Cost %.3f(secs)" % (end_time - start_time) + "\n" + "\n")
+                    f.write("Cost %.3f(secs)" % (end_time - start_time) + "\n")
+                    f.write(
+                        "Data wait %.3f(secs) | compute %.3f(secs)"
+                        % (data_time, compute_time)
+                        + "\n"
+                        + "\n"
+                    )
+
+            # after one epoch, so a fallback applies to the next ones
+            if epoch == 0:
+                self.checkExecutionMode(log_path=log_path)
+
+        # wait for the last checkpoints to be written
+        if self.checkpoint_writer is not None:
+            self.checkpoint_writer.close()
+            self.checkpoint_writer = None
 
         return train_acc, test_acc, train_losses, test_losses
 
-    def saveModel(self, epoch, checkpoint_path):
+    def saveModel(self, epoch, checkpoint_path, score=None):
         """
-        Save the model.
+        Save the model, in the background while training.
         """
-        # torch.save(self.model.state_dict(), save_model_path)
-        torch.save(
-            {
-                "epoch": epoch,
-                "model_state_dict": self.model.state_dict(),
-                "optimizer_state_dict": self.optimizer.state_dict(),
-                "loss": self.criterion.state_dict(),
-            },
-            checkpoint_path,
-        )
+        model_state_dict = self.model.state_dict()
+        if self.checkpoint_mode == "lean":
+            trained_keys = self.getTrainedKeys()
+            model_state_dict = {
+                key: value
+                for key, value in model_state_dict.items()
+                if key in trained_keys
+            }
+        state = {
+            "epoch": epoch,
+            "lean": self.checkpoint_mode == "lean",
+            "base_weights": self.base_weights,
+            "model_state_dict": model_state_dict,
+            "optimizer_state_dict": self.optimizer.state_dict(),
+            "loss": self.criterion.state_dict(),
+            # family names of the outputs, for the inference service
+            "classes": getattr(self.input_data, "classes", None),
+        }
+        if self.checkpoint_writer is None:
+            torch.save(state, checkpoint_path)
+            return
+        # copy the tensors off the model, training goes on updating them
+        self.checkpoint_writer.submit(copy.deepcopy(state), checkpoint_path, score)
 
     def validateModel(self):
         """
-        Validate the model.
+        Validate the model, return the accuracy and the loss.
         """
         self.model.eval()  # set the model to evaluation mode
+        start_time = time.time()
         total_test = 0
         correct_test = 0
         test_loss = 0.0
         iter2 = 0
-        for x, label in tqdm(self.valid_loader, ncols=50):
+        for x, label in tqdm(
+            self.valid_loader, ncols=50, disable=not is_main_process()
+        ):
             with torch.no_grad():  # turn off gradients for evaluation
-                x, label = x.to(self.device), label.to(self.device)
-                test_output = self.model(
+                x = x.to(self.device, non_blocking=self.pin_memory)
+                label = label.to(self.device, non_blocking=self.pin_memory)
+                test_output = self.forward(
                     x
                 )  # forward pass: compute predicted outputs by passing inputs to the model
                 test_loss_c = self.criterion(
@@ -237,7 +826,25 @@ class VGG16:
                 test_loss += test_loss_c.item()
                 iter2 += 1
 
-        print(
+        # sum the counts of all the processes, when distributed
+        correct_test, total_test, test_loss, iter2 = all_reduce_sum(
+            torch.as_tensor(correct_test), total_test, test_loss, iter2
+        )
+        print_main(
             "Testing acc: %.3f | loss: %.3f"
             % (correct_test / total_test, test_loss / iter2)
         )
+        seconds = time.time() - start_time
+        metrics.observe("validate_seconds", seconds)
+        metrics.log(
+            "validate",
+            precision=self.precision,
+            channels_last=self.channels_last,
+            compile=self.compile,
+            acc=(correct_test / total_test).item(),
+            loss=test_loss / iter2,
+            seconds=seconds,
+            samples_per_sec=total_test / seconds,
+        )
+        metrics.write()
+        return (correct_test / total_test).item(), test_loss / iter2
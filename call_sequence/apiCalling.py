@@ -1,30 +1,226 @@
 import os
+import random
+import threading
 import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime
 
 import requests
 import ujson
+from metrics import metrics
+from requests.adapters import HTTPAdapter
+from utils import REPORT_EXTENSIONS, open_report
 
 
-class DynamicAnalysis:
-    def __init__(self, API_TOKEN):
-        self.HEADERS = {"Authorization": f"Bearer {API_TOKEN}"}
+class CompletionTimeEstimator:
+    """
+    Remember how long past analyses took, per family and per sample size
+    """
 
-    def get_analysis_report_id(
-        self, dir_path, file_name, url="http://localhost:8090/tasks/create/file"
+    def __init__(self, history_path=None, max_history=50, min_history=3):
+        self.history_path = history_path
+        self.max_history = max_history
+        self.min_history = min_history
+        self.lock = threading.Lock()
+        self.history = {}
+        if history_path is not None and os.path.exists(history_path):
+            with open(history_path, "r") as f:
+                self.history = ujson.load(f)
+
+    def get_keys(self, family, sample_size):
+        """
+        Get the history keys of a sample, the most specific one first
+        """
+        keys = []
+        if family:
+            keys.append(f"family:{family}")
+        if sample_size is not None:
+            # power-of-two size buckets
+            keys.append(f"size:{int(sample_size).bit_length()}")
+        return keys
+
+    def estimate(self, family, sample_size, default):
+        """
+        Get the lower quartile of the past analysis times, or default if
+        there is not enough history yet
+        """
+        with self.lock:
+            for key in self.get_keys(family, sample_size):
+                durations = self.history.get(key, [])
+                if len(durations) >= self.min_history:
+                    return sorted(durations)[len(durations) // 4]
+        return default
+
+    def record(self, family, sample_size, duration):
+        """
+        Record the analysis time of a finished sample
+        """
+        with self.lock:
+            for key in self.get_keys(family, sample_size):
+                durations = self.history.setdefault(key, [])
+                durations.append(duration)
+                del durations[: -self.max_history]
+            if self.history_path is not None:
+                with open(self.history_path, "w") as f:
+                    ujson.dump(self.history, f)
+
+
+class SandboxNode:
+    """
+    A sandbox host, with its own token and number of samples it analyzes at
+    the same time.
+
+    After max_failures failed requests in a row the node is drained: it gets
+    no new samples for cooldown sec, then it is tried again.
+    """
+
+    def __init__(self, url, token, limit=1, max_failures=3, cooldown=60):
+        self.url = url.rstrip("/")
+        self.headers = {"Authorization": f"Bearer {token}"}
+        self.limit = max(1, limit)
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        self.in_flight = 0
+        self.failures = 0
+        self.drained_until = 0.0
+
+    def is_healthy(self):
+        return time.monotonic() >= self.drained_until
+
+    def record(self, ok):
+        """
+        Record the outcome of a request, drain the node if it keeps failing.
+        """
+        if ok:
+            self.failures = 0
+            return
+        self.failures += 1
+        if self.failures >= self.max_failures and self.is_healthy():
+            print(f"Sandbox {self.url} failed {self.failures} times, draining it.")
+            self.drained_until = time.monotonic() + self.cooldown
+            metrics.inc("sandbox_node_drains_total", node=self.url)
+
+
+class SandboxPool:
+    """
+    Route the samples to the least loaded healthy sandbox node.
+    """
+
+    def __init__(self, nodes):
+        self.nodes = nodes
+        self.condition = threading.Condition()
+
+    def capacity(self):
+        return sum(node.limit for node in self.nodes)
+
+    def acquire(self, exclude=()):
+        """
+        Take a slot on the healthy node with the lowest share of its limit in
+        use, waiting for one to free up or to come back from draining.
+        Return None if every node is excluded.
+        """
+        with self.condition:
+            while True:
+                nodes = [node for node in self.nodes if node not in exclude]
+                if not nodes:
+                    return None
+                free = [
+                    node
+                    for node in nodes
+                    if node.is_healthy() and node.in_flight < node.limit
+                ]
+                if free:
+                    node = min(free, key=lambda node: node.in_flight / node.limit)
+                    node.in_flight += 1
+                    metrics.set("sandbox_node_in_flight", node.in_flight, node=node.url)
+                    return node
+                # wait for a release, or for a drained node to end its cooldown
+                drained = [
+                    node.drained_until for node in nodes if not node.is_healthy()
+                ]
+                timeout = min(drained) - time.monotonic() if drained else None
+                self.condition.wait(timeout)
+
+    def release(self, node):
+        with self.condition:
+            node.in_flight -= 1
+            metrics.set("sandbox_node_in_flight", node.in_flight, node=node.url)
+            self.condition.notify_all()
+
+    def record(self, node, ok):
+        with self.condition:
+            node.record(ok)
+            metrics.set("sandbox_node_healthy", int(node.is_healthy()), node=node.url)
+
+
+class DynamicAnalysis:
+    def __init__(
+        self,
+        API_TOKEN,
+        max_in_flight=1,
+        history_path=None,
+        max_request_interval=30,
+        compression=None,
+        base_url="http://localhost:8090",
+        nodes=None,
+        submit_delay=1,
     ):
+        """
+        nodes is a list of sandbox hosts, dicts with the "url", "token" and
+        "limit" of each, and optionally "max_failures" and "cooldown" (sec).
+        Without it, the only host is base_url with API_TOKEN and max_in_flight.
+        """
+        if nodes is None:
+            nodes = [{"url": base_url, "token": API_TOKEN, "limit": max_in_flight}]
+        self.pool = SandboxPool([SandboxNode(**node) for node in nodes])
+        # the first node is the default one, e.g. a local mock for load tests
+        self.HEADERS = self.pool.nodes[0].headers
+        self.base_url = self.pool.nodes[0].url
+        # number of samples kept in the sandboxes at the same time
+        self.max_in_flight = self.pool.capacity()
+        # learn the first status check time from past runs
+        self.estimator = CompletionTimeEstimator(history_path)
+        # upper bound of the backoff between two status checks
+        self.max_request_interval = max_request_interval
+        # pause after each submission, in sec
+        self.submit_delay = submit_delay
+        # compression of the saved reports: None, "gzip" or "zstd"
+        self.compression = compression
+        # reuse connections across requests instead of opening one per call
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=self.max_in_flight)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def get_analysis_report_id(self, dir_path, file_name, url=None, node=None):
         """
         Submit malware and then get report id
         """
+        node = node or self.pool.nodes[0]
+        url = url or f"{node.url}/tasks/create/file"
         input_file_path = os.path.join(dir_path, file_name)
         with open(input_file_path, mode="rb") as sample:
             files = {"file": ("temp_file_name", sample)}
             # POST
-            r = requests.post(url, headers=self.HEADERS, files=files)
-            time.sleep(1)
-            # get task_id (report id)
-            if "task_id" in r.json():
-                return r.json()["task_id"]
-            else:
+            metrics.inc("sandbox_http_requests_total", endpoint="create")
+            try:
+                with metrics.timer("sandbox_http_seconds", endpoint="create"):
+                    r = self.session.post(url, headers=node.headers, files=files)
+            except requests.exceptions.RequestException as e:
+                # e.g. the node is down, the sample goes to another one
+                metrics.inc("sandbox_http_errors_total", endpoint="create")
+                print("Error submitting sample:", e)
+                return -1
+            time.sleep(self.submit_delay)
+            if r.status_code != 200:
+                metrics.inc("sandbox_http_errors_total", endpoint="create")
+                return -1
+            # get task_id (report id), a proxy error page is not JSON
+            try:
+                return r.json().get("task_id", -1)
+            except ValueError:
+                print("Unexpected response to the submission:", r.text[:100])
+                metrics.inc("sandbox_http_errors_total", endpoint="create")
                 return -1
 
     def save_report(
@@ -32,29 +228,263 @@ class DynamicAnalysis:
         dir_path,
         file_name,
         task_id,
-        url="http://localhost:8090/tasks/report/",
+        url=None,
+        chunk_size=1 << 20,
+        node=None,
     ):
         """
-        Get report and save as json file
+        Get report and stream it to a json file, compressed if configured
         """
-        output_file_path = os.path.join(dir_path, file_name + ".json")
+        node = node or self.pool.nodes[0]
+        url = url or f"{node.url}/tasks/report/"
+        output_file_path = os.path.join(
+            dir_path, file_name + REPORT_EXTENSIONS[self.compression]
+        )
+        # write to a temporary file first, so an interrupted download is never
+        # mistaken for a finished report
+        temp_file_path = output_file_path + ".part"
         # GET
+        metrics.inc("sandbox_http_requests_total", endpoint="report")
         try:
-            response = requests.get(url + str(task_id), headers=self.HEADERS)
-            if response.status_code != 200:
-                return response.status_code
-            response.raise_for_status()
-            with open(output_file_path, "w") as json_file:
-                report = ujson.loads(response.text)
-                ujson.dump(report, json_file)
+            # including the download of the report
+            with metrics.timer("sandbox_http_seconds", endpoint="report"):
+                with self.session.get(
+                    url + str(task_id), headers=node.headers, stream=True
+                ) as response:
+                    if response.status_code != 200:
+                        metrics.inc("sandbox_http_errors_total", endpoint="report")
+                        return response.status_code
+                    response.raise_for_status()
+                    with open_report(temp_file_path, "wb") as json_file:
+                        for chunk in response.iter_content(chunk_size=chunk_size):
+                            json_file.write(chunk)
+                            metrics.inc("sandbox_report_bytes_total", len(chunk))
+            os.replace(temp_file_path, output_file_path)
         except requests.exceptions.RequestException as e:
+            metrics.inc("sandbox_http_errors_total", endpoint="report")
             print("Error fetching report:", e)
+            if os.path.exists(temp_file_path):
+                os.remove(temp_file_path)
             return -1
-        except ujson.JSONDecodeError as e:
-            print("Error decoding JSON response:", e)
-            return -2
         return 200
 
+    def get_task(self, task_id, url=None, node=None):
+        """
+        Get the details of a task, with its status, e.g. "running" or
+        "reported", and timestamps, or None
+        """
+        node = node or self.pool.nodes[0]
+        url = url or f"{node.url}/tasks/view/"
+        metrics.inc("sandbox_http_requests_total", endpoint="view")
+        try:
+            with metrics.timer("sandbox_http_seconds", endpoint="view"):
+                response = self.session.get(url + str(task_id), headers=node.headers)
+            if response.status_code != 200:
+                metrics.inc("sandbox_http_errors_total", endpoint="view")
+                return None
+            task = response.json()["task"]
+            if "status" not in task:
+                raise KeyError("status")
+            return task
+        except requests.exceptions.RequestException as e:
+            metrics.inc("sandbox_http_errors_total", endpoint="view")
+            print("Error fetching task status:", e)
+        except (ValueError, KeyError, TypeError) as e:
+            print("Error decoding task status:", e)
+        return None
+
+    def get_task_status(self, task_id, url=None, node=None):
+        """
+        Get the status of a task, e.g. "running" or "reported"
+        """
+        task = self.get_task(task_id, url, node)
+        return None if task is None else task["status"]
+
+    def get_task_seconds(self, task, start, end):
+        """
+        Get the sec between two timestamps of a task, e.g. "added_on" and
+        "started_on", or None if the sandbox does not report them
+        """
+        try:
+            start_time = datetime.fromisoformat(task[start])
+            end_time = datetime.fromisoformat(task[end])
+        except (KeyError, TypeError, ValueError):
+            return None
+        return (end_time - start_time).total_seconds()
+
+    def record_queue_wait(self, task):
+        """
+        Record how long a task waited in the sandbox queue, from the times it
+        was added and started, if the sandbox reports them
+        """
+        queue_wait = self.get_task_seconds(task, "added_on", "started_on")
+        if queue_wait is not None:
+            metrics.observe("sandbox_queue_wait_seconds", queue_wait)
+
+    def wait_for_report(
+        self,
+        dir_path,
+        file_name,
+        task_id,
+        base_time,
+        request_interval,
+        max_wait_time,
+        family=None,
+        sample_size=None,
+        node=None,
+    ):
+        """
+        Wait for the task to be reported, then save the report.
+
+        The first check happens after the time similar samples usually take
+        (base_time without history), then the status is polled with
+        exponential backoff and jitter. The time learned is the one the
+        sandbox reports, as the time waited is never below the first check.
+
+        Once the task is reported, only the download is retried, with the same
+        backoff, from the node that ran the task even if it was drained
+        meanwhile.
+        """
+        node = node or self.pool.nodes[0]
+        start_time = time.monotonic()
+        first_wait = self.estimator.estimate(family, sample_size, base_time)
+        time.sleep(min(first_wait, max_wait_time))
+        interval = request_interval
+        first_check = True
+        reported = None
+        while True:
+            if reported is None:
+                task = self.get_task(task_id, node=node)
+                self.pool.record(node, task is not None)
+                status = None if task is None else task["status"]
+                if status is not None and status.startswith("failed"):
+                    print(f"Analysis of {file_name} failed: {status}")
+                    return -3
+                if status == "reported":
+                    reported = task
+                    self.record_queue_wait(task)
+            if reported is not None:
+                status_code = self.save_report(dir_path, file_name, task_id, node=node)
+                self.pool.record(node, status_code == 200)
+                if status_code == 200:
+                    duration = time.monotonic() - start_time
+                    metrics.observe("sandbox_analysis_seconds", duration)
+                    analysis_time = self.get_task_seconds(
+                        reported, "started_on", "completed_on"
+                    )
+                    if analysis_time is None and not first_check:
+                        # only bounded by the polls, so still a fair guess
+                        analysis_time = duration
+                    if analysis_time is not None:
+                        self.estimator.record(family, sample_size, analysis_time)
+                    return status_code
+            remaining = max_wait_time - (time.monotonic() - start_time)
+            if remaining <= 0:
+                if reported is not None:
+                    print(f"Could not fetch the report of {file_name}.")
+                    return status_code
+                print(f"Timed out waiting for the report of {file_name}.")
+                return -1
+            # equal jitter: sleep between half and the full interval
+            time.sleep(min(interval * random.uniform(0.5, 1.0), remaining))
+            first_check = first_check and reported is not None
+            interval = min(interval * 2, self.max_request_interval)
+
+    def analyze_sample(
+        self,
+        sample_dir,
+        sample,
+        output_dir,
+        base_time,
+        request_interval,
+        max_wait_time,
+        family=None,
+    ):
+        """
+        Submit one sample and wait for its report, return the status code
+        """
+        sample_size = os.path.getsize(os.path.join(sample_dir, sample))
+        tried = []
+        while True:
+            # a failed submission is retried once on each of the other nodes
+            node = self.pool.acquire(exclude=tried)
+            if node is None:
+                print("The file is not processed successfully.")
+                return -1
+            try:
+                task_id = self.get_analysis_report_id(sample_dir, sample, node=node)
+                self.pool.record(node, task_id >= 0)
+                if task_id < 0:
+                    tried.append(node)
+                    continue
+                metrics.inc("sandbox_node_tasks_total", node=node.url)
+                file_name = os.path.splitext(sample)[0]
+                return self.wait_for_report(
+                    output_dir,
+                    file_name,
+                    task_id,
+                    base_time,
+                    request_interval,
+                    max_wait_time,
+                    family,
+                    sample_size,
+                    node,
+                )
+            finally:
+                self.pool.release(node)
+
+    def analyze_concurrently(
+        self,
+        sample_dir,
+        samples,
+        output_dir,
+        base_time,
+        request_interval,
+        max_wait_time,
+        families=None,
+    ):
+        """
+        Keep up to max_in_flight samples in the sandbox at once and yield
+        (sample, status code) as soon as each report is collected.
+
+        Samples are pulled from the iterable lazily, only when a slot frees up.
+        families optionally maps a sample to its family for the wait estimate.
+        """
+        families = families or {}
+        samples = iter(samples)
+        in_flight = {}
+        with ThreadPoolExecutor(max_workers=self.max_in_flight) as executor:
+            while True:
+                # fill the free slots
+                while len(in_flight) < self.max_in_flight:
+                    sample = next(samples, None)
+                    if sample is None:
+                        break
+                    future = executor.submit(
+                        self.analyze_sample,
+                        sample_dir,
+                        sample,
+                        output_dir,
+                        base_time,
+                        request_interval,
+                        max_wait_time,
+                        families.get(sample),
+                    )
+                    in_flight[future] = sample
+                if not in_flight:
+                    return
+                # collect whichever tasks finished first
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    sample = in_flight.pop(future)
+                    try:
+                        status_code = future.result()
+                    except Exception as e:
+                        print("Error analyzing sample:", e)
+                        status_code = -1
+                    metrics.inc("sandbox_samples_total", status=status_code)
+                    yield sample, status_code
+
 
 def clear_report_log(headers, check_range, url="http://localhost:8090/tasks/delete/"):
     """
@@ -0,0 +1,428 @@
+"""
+Benchmarks of the preprocessing stages on synthetic sandbox reports.
+
+Usage:
+    python benchmark.py parse --calls 10000 100000 1000000
+    python benchmark.py classifiers --store features --epochs 10
+    python benchmark.py scaling --store features --workers 1 2 4 8
+    python benchmark.py suite --reports 20 --calls 20000 --output results.json
+    python benchmark.py suite --output new.json --baseline results.json
+"""
+
+import argparse
+import os
+import platform
+import socket
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import torch
+import torch.multiprocessing as mp
+import ujson
+from distributedTraining import cleanup
+from featureStore import FeatureStore
+from imageGenerator import ImageGenerator, iter_calls, load_calls
+from malwareClassification import ENGINES
+from syntheticReport import CATEGORY_MIX, write_synthetic_report
+from utils import open_report
+
+
+def measure(func, *args):
+    """
+    Get the run time (sec) and the peak traced memory (bytes) of a call
+    """
+    start_time = time.perf_counter()
+    func(*args)
+    seconds = time.perf_counter() - start_time
+    # run again under tracemalloc, which slows the call down
+    tracemalloc.start()
+    func(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return seconds, peak
+
+
+def count_calls(read_calls, path):
+    with open_report(path) as report:
+        return sum(1 for _ in read_calls(report))
+
+
+def benchmark_parse(sizes):
+    """
+    Compare loading the whole report with the streaming call parser
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for num_calls in sizes:
+            path = os.path.join(tmp_dir, f"{num_calls}.json")
+            write_synthetic_report(path, num_calls)
+            print(
+                "%d calls, %.1f MiB report" % (num_calls, os.path.getsize(path) / 2**20)
+            )
+            for name, read_calls in (
+                ("ujson.load", load_calls),
+                ("streaming", iter_calls),
+            ):
+                seconds, peak = measure(count_calls, read_calls, path)
+                print(
+                    "  %-10s %.3f(secs) | peak memory %.1f MiB"
+                    % (name, seconds, peak / 2**20)
+                )
+
+
+def benchmark_classifiers(
+    store_dir,
+    color_map,
+    engines,
+    epochs,
+    batch_size=8,
+    learning_rate=1e-3,
+    train_ratio=0.8,
+    seed=0,
+):
+    """
+    Train the classifier engines on the same split of a feature store, then
+    compare their accuracy, training time and inference throughput
+    """
+    results = {}
+    for name in engines:
+        classifier = ENGINES[name](batch_size, learning_rate, "counts")
+        classifier.loadData(store_dir, color_map)
+        torch.manual_seed(seed)  # the same split for every engine
+        classifier.splitTrainData(train_ratio)
+        classifier.loadModel()
+        start_time = time.perf_counter()
+        classifier.trainModel(epochs)
+        train_time = time.perf_counter() - start_time
+        accuracy, _ = classifier.validateModel()
+        # inference over the whole store, without the loss and the metrics
+        classifier.network.eval()
+        loader = classifier.makeLoader(classifier.input_data, shuffle=False)
+        start_time = time.perf_counter()
+        with torch.inference_mode():
+            for x, _ in loader:
+                classifier.forward(x.to(classifier.device))
+        throughput = len(classifier.input_data) / (time.perf_counter() - start_time)
+        results[name] = (accuracy, train_time, throughput)
+    print("%-8s %9s %16s %14s" % ("engine", "acc", "train(secs)", "samples/sec"))
+    for name, (accuracy, train_time, throughput) in results.items():
+        print("%-8s %9.3f %16.1f %14.1f" % (name, accuracy, train_time, throughput))
+    return results
+
+
+def train_worker(rank, world_size, port, result_path, args):
+    """
+    Train in one of world_size processes, rank 0 writes the throughput.
+    """
+    store_dir, color_map, engine, epochs, batch_size, train_ratio = args
+    os.environ.update(
+        MASTER_ADDR="127.0.0.1",
+        MASTER_PORT=str(port),
+        RANK=str(rank),
+        WORLD_SIZE=str(world_size),
+        LOCAL_RANK=str(rank),
+        LOCAL_WORLD_SIZE=str(world_size),
+    )
+    torch.manual_seed(0)
+    classifier = ENGINES[engine](batch_size, 1e-3, "counts", distributed=True)
+    classifier.loadData(store_dir, color_map)
+    classifier.splitTrainData(train_ratio)
+    classifier.loadModel()
+    start_time = time.perf_counter()
+    _, test_acc, _, _ = classifier.trainModel(epochs)
+    seconds = time.perf_counter() - start_time
+    if rank == 0:
+        with open(result_path, "w") as f:
+            ujson.dump(
+                {
+                    "seconds": seconds,
+                    "samples_per_sec": epochs * len(classifier.input_data) / seconds,
+                    "threads": torch.get_num_threads(),
+                    "test_acc": float(test_acc[-1]),
+                },
+                f,
+            )
+    cleanup()
+
+
+def benchmark_scaling(
+    store_dir, color_map, workers, engine="vgg16", epochs=1, batch_size=8
+):
+    """
+    Train with more and more data-parallel processes on this node, sharing
+    its cores, and report the samples/sec gained per added worker
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for world_size in workers:
+            result_path = os.path.join(tmp_dir, f"{world_size}.json")
+            # a free port for the process group
+            with socket.socket() as s:
+                s.bind(("127.0.0.1", 0))
+                port = s.getsockname()[1]
+            args = (store_dir, color_map, engine, epochs, batch_size, 0.8)
+            mp.spawn(
+                train_worker,
+                args=(world_size, port, result_path, args),
+                nprocs=world_size,
+            )
+            with open(result_path, "r") as f:
+                results[world_size] = ujson.load(f)
+    print(
+        "%-8s %8s %12s %9s %11s %14s"
+        % ("workers", "threads", "samples/sec", "speedup", "efficiency", "gain/worker")
+    )
+    base_workers, base = workers[0], results[workers[0]]["samples_per_sec"]
+    previous = None
+    for world_size, result in results.items():
+        rate = result["samples_per_sec"]
+        speedup = rate / base
+        gain = ""
+        if previous is not None:
+            gain = "%+.1f" % ((rate - previous[1]) / (world_size - previous[0]))
+        print(
+            "%-8d %8d %12.1f %8.2fx %10.0f%% %14s"
+            % (
+                world_size,
+                result["threads"],
+                rate,
+                speedup,
+                100 * speedup * base_workers / world_size,
+                gain,
+            )
+        )
+        previous = (world_size, rate)
+    return results
+
+
+def parse_category_mix(pairs):
+    """
+    Parse a category mix given as category=weight pairs
+    """
+    category_mix = {}
+    for pair in pairs:
+        category, weight = pair.rsplit("=", 1)
+        category_mix[category] = float(weight)
+    return category_mix
+
+
+def time_stage(stages, name, num_items, func, min_time=0.5):
+    """
+    Time a stage processing num_items items and record it in stages
+
+    Fast stages are run again until min_time sec, to time them reliably.
+    """
+    runs = 0
+    start_time = time.perf_counter()
+    while runs == 0 or time.perf_counter() - start_time < min_time:
+        func()
+        runs += 1
+    seconds = (time.perf_counter() - start_time) / runs
+    stages[name] = {
+        "seconds": seconds,
+        "items": num_items,
+        "items_per_sec": num_items / seconds,
+        "runs": runs,
+    }
+    print("  %-22s %9.3f(secs) %12.1f items/sec" % (name, seconds, num_items / seconds))
+
+
+def benchmark_suite(
+    num_reports,
+    num_calls,
+    color_map,
+    category_mix=CATEGORY_MIX,
+    engine="vgg16",
+    batch_size=8,
+    train_steps=3,
+    num_families=4,
+):
+    """
+    Time every stage from synthetic reports to inference, return the results
+
+    The items are calls for parse, samples otherwise.
+    """
+    config = {
+        "reports": num_reports,
+        "calls": num_calls,
+        "category_mix": category_mix,
+        "engine": engine,
+        "batch_size": batch_size,
+        "train_steps": train_steps,
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "cpus": os.cpu_count(),
+        "threads": torch.get_num_threads(),
+    }
+    stages = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        dirs = [os.path.join(tmp_dir, d) for d in ("json", "csv", "npy", "graph")]
+        for d in dirs:
+            os.makedirs(d)
+        names = ["r%04d" % i for i in range(num_reports)]
+        for i, name in enumerate(names):
+            path = os.path.join(dirs[0], f"{name}.json")
+            write_synthetic_report(path, num_calls, seed=i, category_mix=category_mix)
+        generator = ImageGenerator(*dirs, color_map)
+
+        def run(stage):
+            return lambda: [getattr(generator, stage)(name) for name in names]
+
+        print("Stages")
+        time_stage(
+            stages,
+            "parse",
+            num_reports * num_calls,
+            lambda: [
+                count_calls(iter_calls, os.path.join(dirs[0], f"{name}.json"))
+                for name in names
+            ],
+        )
+        time_stage(stages, "extract_feature", num_reports, run("extract_feature"))
+        time_stage(
+            stages, "generate_vector_array", num_reports, run("generate_vector_array")
+        )
+        time_stage(stages, "generate_image", num_reports, run("generate_image"))
+        time_stage(stages, "process_report", num_reports, run("process_report"))
+
+        # pack the features with a few synthetic families to train on
+        store_dir = os.path.join(tmp_dir, "features")
+        store = FeatureStore(store_dir)
+        for i, name in enumerate(names):
+            feature_array = generator.process_report(name)
+            store.add(name, "family%d" % (i % num_families), feature_array)
+        store.flush()
+        classifier = ENGINES[engine](batch_size, 1e-3, "counts")
+        classifier.loadData(store_dir, color_map)
+        loader = classifier.makeLoader(classifier.input_data, shuffle=True)
+        time_stage(stages, "loader", num_reports, lambda: [_ for _ in loader])
+
+        classifier.loadModel()
+        batches = [batch for batch, _ in zip(loader, range(train_steps))]
+
+        def train_steps_():
+            classifier.model.train()
+            for x, label in batches:
+                classifier.optimizer.zero_grad()
+                output = classifier.forward(x.to(classifier.device))
+                classifier.criterion(output, label.to(classifier.device)).backward()
+                classifier.optimizer.step()
+
+        def inference():
+            classifier.model.eval()
+            with torch.inference_mode():
+                for x, _ in loader:
+                    classifier.forward(x.to(classifier.device))
+
+        num_trained = sum(len(label) for _, label in batches)
+        time_stage(stages, "train_step", num_trained, train_steps_)
+        time_stage(stages, "inference", num_reports, inference)
+    return {"config": config, "stages": stages}
+
+
+def compare_results(results, baseline, threshold=0.1):
+    """
+    Compare the throughput of every stage with a baseline, return the stages
+    slower than the baseline by more than threshold
+    """
+    regressions = []
+    changed = [
+        key
+        for key, value in results["config"].items()
+        if baseline["config"].get(key) != value
+    ]
+    if changed:
+        print("Config differs from the baseline:", ", ".join(changed))
+    print("%-22s %14s %14s %9s" % ("stage", "baseline/sec", "current/sec", "change"))
+    for name, stage in results["stages"].items():
+        if name not in baseline["stages"]:
+            continue
+        baseline_rate = baseline["stages"][name]["items_per_sec"]
+        change = stage["items_per_sec"] / baseline_rate - 1
+        flag = ""
+        if change < -threshold:
+            regressions.append(name)
+            flag = "REGRESSION"
+        print(
+            "%-22s %14.1f %14.1f %+8.1f%% %s"
+            % (name, baseline_rate, stage["items_per_sec"], change * 100, flag)
+        )
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+    parse_parser = subparsers.add_parser("parse", help="report parsing")
+    parse_parser.add_argument(
+        "--calls", type=int, nargs="+", default=[10000, 100000, 1000000]
+    )
+    classifiers_parser = subparsers.add_parser(
+        "classifiers", help="classifier engines on a feature store"
+    )
+    classifiers_parser.add_argument("--store", default="features")
+    classifiers_parser.add_argument("--color-map", default="APIColorMappingRule.json")
+    classifiers_parser.add_argument(
+        "--engines", nargs="+", default=list(ENGINES), choices=list(ENGINES)
+    )
+    classifiers_parser.add_argument("--epochs", type=int, default=10)
+    classifiers_parser.add_argument("--batch-size", type=int, default=8)
+    scaling_parser = subparsers.add_parser(
+        "scaling", help="data-parallel training throughput per worker"
+    )
+    scaling_parser.add_argument("--store", default="features")
+    scaling_parser.add_argument("--color-map", default="APIColorMappingRule.json")
+    scaling_parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    scaling_parser.add_argument("--engine", default="vgg16", choices=list(ENGINES))
+    scaling_parser.add_argument("--epochs", type=int, default=1)
+    scaling_parser.add_argument("--batch-size", type=int, default=8)
+    suite_parser = subparsers.add_parser("suite", help="every stage end to end")
+    suite_parser.add_argument("--reports", type=int, default=20)
+    suite_parser.add_argument("--calls", type=int, default=20000)
+    suite_parser.add_argument(
+        "--mix", nargs="+", help="category mix, e.g. file=30 register=20"
+    )
+    suite_parser.add_argument("--color-map", default="APIColorMappingRule.json")
+    suite_parser.add_argument("--engine", default="vgg16", choices=list(ENGINES))
+    suite_parser.add_argument("--batch-size", type=int, default=8)
+    suite_parser.add_argument("--train-steps", type=int, default=3)
+    suite_parser.add_argument("--output", help="write the results as JSON")
+    suite_parser.add_argument("--baseline", help="results JSON to compare with")
+    suite_parser.add_argument(
+        "--threshold", type=float, default=0.1, help="slowdown flagged, e.g. 0.1"
+    )
+    args = parser.parse_args()
+    if args.benchmark == "parse":
+        benchmark_parse(args.calls)
+    elif args.benchmark == "classifiers":
+        benchmark_classifiers(
+            args.store, args.color_map, args.engines, args.epochs, args.batch_size
+        )
+    elif args.benchmark == "scaling":
+        benchmark_scaling(
+            args.store,
+            args.color_map,
+            args.workers,
+            args.engine,
+            args.epochs,
+            args.batch_size,
+        )
+    elif args.benchmark == "suite":
+        results = benchmark_suite(
+            args.reports,
+            args.calls,
+            args.color_map,
+            parse_category_mix(args.mix) if args.mix else CATEGORY_MIX,
+            args.engine,
+            args.batch_size,
+            args.train_steps,
+        )
+        if args.output:
+            with open(args.output, "w") as f:
+                ujson.dump(results, f, indent=2)
+        if args.baseline:
+            with open(args.baseline, "r") as f:
+                baseline = ujson.load(f)
+            if compare_results(results, baseline, args.threshold):
+                sys.exit(1)
@@ -0,0 +1,87 @@
+import os
+import queue
+import threading
+import time
+
+import torch
+from metrics import metrics
+
+
+class CheckpointWriter:
+    """
+    Write checkpoints in a background thread, so training does not wait on
+    the disk, and rotate them.
+
+    After each write, only the keep_last newest checkpoints and the keep_best
+    ones with the highest score are kept, keep_last None keeps them all.
+    At most one checkpoint waits to be written, a submit blocks meanwhile.
+    """
+
+    def __init__(self, keep_last=None, keep_best=0):
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        # (path, score) of the written checkpoints, oldest first
+        self.saved = []
+        self.checkpoints = queue.Queue(maxsize=1)
+        self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+
+    def submit(self, state, path, score=None):
+        """
+        Queue a checkpoint, a state dict already copied off the model.
+        """
+        self.checkpoints.put((state, path, score))
+
+    def run(self):
+        while True:
+            checkpoint = self.checkpoints.get()
+            try:
+                if checkpoint is None:
+                    return
+                self.write(*checkpoint)
+            finally:
+                self.checkpoints.task_done()
+
+    def write(self, state, path, score):
+        start_time = time.perf_counter()
+        try:
+            # replace the file at once, so a crash never leaves half of it
+            torch.save(state, path + ".part")
+            os.replace(path + ".part", path)
+        except Exception as e:
+            print("Error saving checkpoint:", path, e)
+            metrics.inc("checkpoint_errors_total")
+            return
+        metrics.observe("checkpoint_write_seconds", time.perf_counter() - start_time)
+        metrics.set("checkpoint_bytes", os.path.getsize(path))
+        self.saved = [(p, s) for p, s in self.saved if p != path]
+        self.saved.append((path, score))
+        self.rotate()
+
+    def rotate(self):
+        """
+        Delete the checkpoints that are neither the newest nor the best.
+        """
+        if self.keep_last is None:
+            return
+        newest = self.saved[-self.keep_last :] if self.keep_last else []
+        keep = {path for path, _ in newest}
+        scored = [(score, path) for path, score in self.saved if score is not None]
+        keep.update(path for _, path in sorted(scored, reverse=True)[: self.keep_best])
+        for path, _ in self.saved:
+            if path not in keep and os.path.exists(path):
+                os.remove(path)
+        self.saved = [(path, score) for path, score in self.saved if path in keep]
+
+    def wait(self):
+        """
+        Wait until the queued checkpoints are written.
+        """
+        self.checkpoints.join()
+
+    def close(self):
+        """
+        Write the queued checkpoints and stop the thread.
+        """
+        self.checkpoints.put(None)
+        self.worker.join()
@@ -0,0 +1,83 @@
+import torch
+from distributedTraining import print_main
+from VGG16 import VGG16
+
+
+class CountNet(torch.nn.Module):
+    """
+    Small CNN over the 16x16 count matrix (time bins x categories).
+
+    The counts are log-scaled, since they range from 0 to many thousands.
+    The first convolutions only run along time, one category at a time,
+    then the categories are mixed.
+    """
+
+    def __init__(self, num_classes=25, channels=32):
+        super().__init__()
+        self.features = torch.nn.Sequential(
+            torch.nn.Conv2d(1, channels, kernel_size=(3, 1), padding=(1, 0)),
+            torch.nn.BatchNorm2d(channels),
+            torch.nn.ReLU(inplace=True),
+            torch.nn.Conv2d(channels, channels, kernel_size=(3, 1), padding=(1, 0)),
+            torch.nn.BatchNorm2d(channels),
+            torch.nn.ReLU(inplace=True),
+            torch.nn.MaxPool2d(kernel_size=(2, 1)),
+            torch.nn.Conv2d(channels, 2 * channels, kernel_size=3, padding=1),
+            torch.nn.BatchNorm2d(2 * channels),
+            torch.nn.ReLU(inplace=True),
+            torch.nn.AdaptiveAvgPool2d((2, 4)),
+        )
+        self.classifier = torch.nn.Sequential(
+            torch.nn.Flatten(1),
+            torch.nn.Dropout(0.3),
+            torch.nn.Linear(2 * channels * 2 * 4, 128),
+            torch.nn.ReLU(inplace=True),
+            torch.nn.Linear(128, num_classes),
+        )
+
+    def forward(self, x):
+        x = torch.log1p(x.clamp(min=0)).unsqueeze(1)
+        return self.classifier(self.features(x))
+
+
+class CountClassifier(VGG16):
+    """
+    Classifier working directly on the count matrices of a feature store,
+    a fast path next to VGG16 for bulk triage. The data, training, saving
+    and validation are the same as VGG16 in counts mode.
+    """
+
+    def __init__(self, batch_size, learning_rate, input_mode="counts", **kwargs):
+        if input_mode != "counts":
+            raise ValueError("CountClassifier only takes the counts input mode.")
+        super().__init__(batch_size, learning_rate, input_mode, **kwargs)
+
+    def loadModel(self, pretrained: str = None):
+        """
+        Load the count model.
+        """
+        # trained from scratch, there are no base weights
+        self.base_weights = None
+        self.model = CountNet().to(self.device)
+        # there is no input expansion, the network takes the counts as they are
+        self.network = self.model
+
+        # every layer is trained
+        self.optimizer = torch.optim.Adam(
+            self.model.parameters(), lr=self.learning_rate
+        )
+        self.criterion = torch.nn.CrossEntropyLoss()
+
+        # load pretrained model
+        if pretrained is not None:
+            self.loadCheckpoint(pretrained)
+
+        if self.model_summary:
+            self.printSummary()
+        self.wrapNetwork()
+
+    def cacheActivations(self, cache_dir, dtype="float32"):
+        """
+        Nothing is frozen, so there are no activations to cache.
+        """
+        print_main("CountClassifier has no frozen layers, skip the activation cache.")
@@ -0,0 +1,84 @@
+"""
+Data-parallel training over several processes, on one node or several.
+
+Launch one process per worker with torchrun, e.g. 4 on this node:
+    torchrun --standalone --nproc_per_node 4 main.py train
+or 2 nodes of 4 processes, run on each node with its own --node_rank:
+    torchrun --nnodes 2 --nproc_per_node 4 --node_rank 0 \
+        --master_addr 10.0.0.1 --master_port 29500 main.py train
+"""
+
+import os
+
+import torch
+import torch.distributed as dist
+
+
+def init_distributed(backend="gloo"):
+    """
+    Join the process group described by the torchrun environment variables,
+    return (rank, world size). Does nothing for a single process.
+
+    The cores of the node are shared between its processes.
+    """
+    world_size = int(os.environ.get("WORLD_SIZE", 1))
+    if world_size == 1 or dist.is_initialized():
+        return get_rank(), get_world_size()
+    dist.init_process_group(backend)
+    # torchrun sets OMP_NUM_THREADS=1, which leaves most cores idle
+    local_world_size = int(os.environ.get("LOCAL_WORLD_SIZE", 1))
+    torch.set_num_threads(max(1, len(os.sched_getaffinity(0)) // local_world_size))
+    return dist.get_rank(), dist.get_world_size()
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def print_main(*args, **kwargs):
+    """
+    Print the progress once, from rank 0, warnings and errors use print.
+    """
+    # before joining the process group, the rank is the one torchrun gives
+    rank = get_rank() if is_distributed() else int(os.environ.get("RANK", 0))
+    if rank == 0:
+        print(*args, **kwargs)
+
+
+def barrier():
+    """
+    Wait for all the processes, e.g. until rank 0 wrote a shared file.
+    """
+    if is_distributed():
+        dist.barrier()
+
+
+def all_reduce_sum(*values):
+    """
+    Sum numbers, or 0-d tensors, over all the processes, keeping their types.
+    """
+    if not is_distributed():
+        return values
+    totals = torch.tensor([float(value) for value in values], dtype=torch.float64)
+    dist.all_reduce(totals)
+    return tuple(
+        torch.tensor(total) if torch.is_tensor(value) else type(value)(total)
+        for value, total in zip(values, totals.tolist())
+    )
+
+
+def cleanup():
+    if is_distributed():
+        dist.destroy_process_group()
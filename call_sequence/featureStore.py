@@ -0,0 +1,81 @@
+import os
+
+import numpy as np
+import ujson
+
+
+class FeatureStore:
+    """
+    Feature arrays of all the samples packed in a few memory-mapped shards.
+
+    Each flush writes the added samples as a new shard, features_<n>.npy of
+    shape (samples, time bins, categories), and records their shard, row and
+    label in index.json. A sample added again points to its newest row.
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self.index_path = os.path.join(store_dir, "index.json")
+        self.index = {"shards": [], "samples": {}}
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "r") as f:
+                self.index = ujson.load(f)
+        self.pending = []
+        self.shards = {}
+
+    @staticmethod
+    def exists(store_dir):
+        """
+        Check if a directory holds a feature store.
+        """
+        return os.path.exists(os.path.join(store_dir, "index.json"))
+
+    def add(self, name, label, feature_array):
+        """
+        Add the feature array of a sample, call flush to write it.
+        """
+        self.pending.append((name, label, feature_array))
+
+    def flush(self):
+        """
+        Write the added samples as a new shard.
+        """
+        if not self.pending:
+            return
+        os.makedirs(self.store_dir, exist_ok=True)
+        shard = len(self.index["shards"])
+        shard_name = f"features_{shard:05d}.npy"
+        features = np.stack([array for _, _, array in self.pending])
+        np.save(os.path.join(self.store_dir, shard_name), features.astype(np.float32))
+        self.index["shards"].append(shard_name)
+        for row, (name, label, _) in enumerate(self.pending):
+            self.index["samples"][name] = [shard, row, label]
+        # replace the index at once, so it never points to a missing shard
+        with open(self.index_path + ".part", "w") as f:
+            ujson.dump(self.index, f)
+        os.replace(self.index_path + ".part", self.index_path)
+        self.pending = []
+
+    def get_samples(self):
+        """
+        Get the (name, label) of every sample, sorted by name.
+        """
+        return [
+            (name, label)
+            for name, (_, _, label) in sorted(self.index["samples"].items())
+        ]
+
+    def get_feature_array(self, name):
+        """
+        Get the feature array of a sample, as a read-only memory-mapped view.
+        """
+        shard, row, _ = self.index["samples"][name]
+        if shard not in self.shards:
+            self.shards[shard] = np.load(
+                os.path.join(self.store_dir, self.index["shards"][shard]),
+                mmap_mode="r",
+            )
+        return self.shards[shard][row]
+
+    def __len__(self):
+        return len(self.index["samples"])
@@ -2,15 +2,207 @@ import csv
 import os
 
 import cv2
+import ijson
 import numpy as np
-import pandas as pd
 import ujson
-from utils import hex_to_rgb
+from metrics import metrics
+from utils import find_report, hex_to_rgb, open_report
+
+# call categories, i.e. the columns of the feature array
+CATEGORY = [
+    "networking",
+    "register",
+    "service",
+    "file",
+    "hardware",
+    "message",
+    "process",
+    "system",
+    "Shellcode",
+    "Keylogging",
+    "Obfuscation",
+    "password dumping",
+    "anti-debugging",
+    "handle manipulation",
+    "high risk",
+    "other",
+]
+
+# other names of the categories in the reports, counted as the category
+CATEGORY_ALIASES = {
+    "hash": "password dumping",
+    "reversing": "anti-debugging",
+}
+
+# ijson prefix of a single API call in the report
+CALL_PREFIX = "behavior.processes.item.calls.item"
+
+
+def iter_calls(report):
+    """
+    Yield (category, time) of every API call in a report file, one call at
+    a time, without building the whole document tree
+    """
+    for call in ijson.items(report, CALL_PREFIX, use_float=True):
+        try:
+            yield call["category"], call["time"]
+        except KeyError as e:
+            print("Error calling structure:", e)
+
+
+def load_calls(report):
+    """
+    Yield (category, time) of every API call in a report file, after
+    loading the whole document with ujson
+    """
+    report = ujson.load(report)
+    # iterate over the processes
+    for process in report["behavior"]["processes"]:
+        # iterate over the calls within a process
+        for call in process["calls"]:
+            try:
+                yield call["category"], call["time"]
+            except KeyError as e:
+                print("Error calling structure:", e)
+
+
+def get_category_table(categories, aliases=CATEGORY_ALIASES):
+    """
+    Map every category name, aliases included, to its column index
+    """
+    table = {category: i for i, category in enumerate(categories)}
+    for alias, category in aliases.items():
+        if category in table:
+            table.setdefault(alias, table[category])
+    return table
+
+
+def encode_categories(categories, table):
+    """
+    Encode category names as column indices, -1 for the ones not counted
+    """
+    return np.fromiter(
+        (table.get(category, -1) for category in categories),
+        dtype=np.int64,
+        count=len(categories),
+    )
+
+
+def write_calls(writer, calls):
+    """
+    Write every (category, time) to a csv writer as it passes through
+    """
+    for call in calls:
+        writer.writerow(call)
+        yield call
+
+
+def encode_calls(calls, table):
+    """
+    Encode an iterable of (category, time) as it is consumed, into arrays of
+    column indices (-1 for the categories not counted) and times, so memory
+    grows by 10 bytes per call instead of a Python tuple
+    """
+    records = np.fromiter(
+        ((table.get(category, -1), time) for category, time in calls),
+        dtype=[("code", np.int16), ("time", np.float64)],
+    )
+    return records["code"], records["time"]
+
+
+def bin_calls(codes, times, lengths, num_time_bins, num_categories):
+    """
+    Count the calls of a batch of reports in equal time intervals.
+
+    codes and times are the encoded categories and times of the calls of
+    all the reports concatenated, lengths the number of calls of each report.
+    Return the feature arrays, of shape (reports, time bins, categories).
+
+    The time bins of each report are the same as np.digitize over
+    np.linspace(start, end, num_time_bins + 1): calls at the end time fall
+    out of range and are not counted, like calls with a code of -1.
+    """
+    codes = np.asarray(codes, dtype=np.int64)
+    times = np.asarray(times, dtype=np.float64)
+    lengths = np.asarray(lengths, dtype=np.int64)
+    num_reports = len(lengths)
+    shape = (num_reports, num_time_bins, num_categories)
+    if len(times) == 0:
+        return np.zeros(shape)
+    segment = np.repeat(np.arange(num_reports), lengths)
+    offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    nonempty = lengths > 0
+    start = np.zeros(num_reports)
+    end = np.zeros(num_reports)
+    start[nonempty] = np.minimum.reduceat(times, offsets[nonempty])
+    end[nonempty] = np.maximum.reduceat(times, offsets[nonempty])
+    # the bin edges of every report, exactly as np.linspace computes them
+    edges = np.array(
+        [np.linspace(s, e, num=num_time_bins + 1) for s, e in zip(start, end)]
+    ).reshape(num_reports, num_time_bins + 1)
+    # estimate the bin, then correct the rounding against the edges
+    width = (end - start)[segment]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        time_bin = np.floor((times - start[segment]) / width * num_time_bins)
+    # a report with a single time has all the edges equal, out of range
+    time_bin = np.where(width > 0, time_bin, num_time_bins)
+    time_bin = np.clip(time_bin, 0, num_time_bins).astype(np.int64)
+    time_bin -= (time_bin > 0) & (times < edges[segment, time_bin])
+    upper = np.minimum(time_bin + 1, num_time_bins)
+    time_bin += (time_bin < num_time_bins) & (times >= edges[segment, upper])
+    # only count the known categories within the time intervals
+    mask = (time_bin < num_time_bins) & (codes >= 0)
+    index = (segment * num_time_bins + time_bin) * num_categories + codes
+    counts = np.bincount(index[mask], minlength=np.prod(shape))
+    return counts.reshape(shape).astype(np.float64)
+
+
+def compile_color_map(color_map, categories):
+    """
+    Compile the color rule into lookup tables, in the order of categories.
+
+    Return the thresholds of each category, sorted and padded with inf, and
+    the RGB colors of each category where index 0 is white (count 0) and
+    index i + 1 is the color of threshold i.
+    """
+    with open(color_map, "r") as f:
+        color_map = ujson.load(f)
+    rules = [
+        sorted(color_map[type].items(), key=lambda x: int(x[0])) for type in categories
+    ]
+    num_thresholds = max(len(rule) for rule in rules)
+    thresholds = np.full((len(categories), num_thresholds), np.inf)
+    colors = np.full((len(categories), num_thresholds + 1, 3), 255, dtype=np.uint8)
+    for i, rule in enumerate(rules):
+        for j, (key, color) in enumerate(rule):
+            thresholds[i, j] = int(key)
+            colors[i, j + 1] = hex_to_rgb(color)
+    return thresholds, colors
+
+
+def colorize(feature_array, thresholds, colors):
+    """
+    Colorize a feature array, or a batch of them, with the compiled color map
+
+    A count gets the color of the largest threshold of its category below it
+    (white for 0), i.e. a searchsorted over the thresholds, done for all cells
+    at once by counting the thresholds each count exceeds.
+    """
+    feature_array = np.asarray(feature_array)
+    index = (feature_array[..., None] > thresholds).sum(axis=-1)
+    return colors[np.arange(len(thresholds)), index]
 
 
 class ImageGenerator:
     def __init__(
-        self, input_dir, output_csv_dir, output_npy_dir, output_graph_dir, color_map
+        self,
+        input_dir,
+        output_csv_dir,
+        output_npy_dir,
+        output_graph_dir,
+        color_map,
+        num_time_bins=16,
+        categories=None,
     ):
         """
         Initialize the parameters
@@ -20,131 +212,112 @@ class ImageGenerator:
         self.output_npy_dir = output_npy_dir
         self.output_graph_dir = output_graph_dir
         self.color_map = color_map
-        self.category = [
-            "networking",
-            "register",
-            "service",
-            "file",
-            "hardware",
-            "message",
-            "process",
-            "system",
-            "Shellcode",
-            "Keylogging",
-            "Obfuscation",
-            "password dumping",
-            "anti-debugging",
-            "handle manipulation",
-            "high risk",
-            "other",
-        ]
-
-    def extract_feature(self, file_name):
+        # number of equal time intervals, i.e. the rows of the feature array
+        self.num_time_bins = num_time_bins
+        self.category = list(categories or CATEGORY)
+        # column index of every category name, computed once
+        self.category_table = get_category_table(self.category)
+        self.color_thresholds, self.color_table = compile_color_map(
+            color_map, self.category
+        )
+
+    def extract_feature(self, file_name, streaming=True):
         """
         Extract behavior as feature and save as a csv file
+
+        With streaming, the report is parsed incrementally so memory stays
+        flat whatever the report size; otherwise it is loaded at once.
         """
-        input_file_path = os.path.join(self.input_dir, f"{file_name}.json")
+        input_file_path = find_report(self.input_dir, file_name)
         output_file_path = os.path.join(self.output_csv_dir, f"{file_name}.csv")
-        with open(input_file_path, "r", encoding="utf-8") as input, open(
+        read_calls = iter_calls if streaming else load_calls
+        with open_report(input_file_path) as input, open(
             output_file_path, "w", newline=""
         ) as output:
-            # setup the reader
-            report = ujson.load(input)
             # define field names
             field_name = ["category", "time"]
             # setup the writer
             writer = csv.DictWriter(output, fieldnames=field_name)
             # writer the header
             writer.writeheader()
-            # iterate over the processes
-            for i, process in enumerate(report["behavior"]["processes"]):
-                # iterate over the calls within a process
-                for call in process["calls"]:
-                    try:
-                        # write the call details to the CSV
-                        writer.writerow(
-                            {
-                                "category": call["category"],
-                                "time": call["time"],
-                            }
-                        )
-                    except KeyError as e:
-                        print("Error calling structure:", e)
+            # write the call details to the CSV
+            for category, time in read_calls(input):
+                writer.writerow({"category": category, "time": time})
 
     def get_category(self, category):
         """
-        Get the category of the call
-        """
-        category_dict = {
-            "networking": "networking",
-            "register": "register",
-            "service": "service",
-            "file": "file",
-            "hardware": "hardware",
-            "message": "message",
-            "process": "process",
-            "thread": "thread",
-            "system": "system",
-            "Shellcode": "Shellcode",
-            "Keylogging": "Keylogging",
-            "Obfuscation": "Obfuscation",
-            "password dumping": "password dumping",
-            "hash": "password dumping",
-            "anti-debugging": "anti-debugging",
-            "reversing": "anti-debugging",
-            "handle manipulation": "handle manipulation",
-            "high risk": "high risk",
-        }
-        if category in category_dict:
-            return self.category.index(category)
-        return "other"
+        Get the column index of the call category, or None if it is not counted
+        """
+        return self.category_table.get(category)
 
     def generate_vector_array(self, file_name):
-        df = pd.read_csv(
-            os.path.join(self.output_csv_dir, f"{file_name}.csv"), encoding="utf-8"
-        )
-        start_time = df["time"].min()
-        end_time = df["time"].max()
-        # create an array of bin edges with 16 equal intervals between start and end time
-        time_bins = np.linspace(
-            start_time, end_time, num=17
-        )  # 16 intervals + 1 for the end point
-        # assign each time entry to a time bin
-        df["time_bin"] = (
-            np.digitize(df["time"], bins=time_bins) - 1
-        )  # adjust to get zero-based indexing
-        # ensure the categories are categorical for efficiency
-        df["category"] = df["category"].astype("category")
-        # create a mapping from category to index
-        category_to_index = {cat: idx for idx, cat in enumerate(self.category)}
-        # initialize the image data array
-        feature_array = np.zeros((16, len(self.category)))
-        # group by time_bin and category, then count the occurrences
-        grouped = df.groupby(["time_bin", "category"]).size().unstack(fill_value=0)
-        # reindex the DataFrame to ensure it has 16 rows, representing each time interval
-        grouped = grouped.reindex(range(16), fill_value=0)
-        # assign the counts to the appropriate places in the image_data array
-        for cat in grouped.columns:
-            cat_idx = category_to_index.get(cat)
-            if cat_idx is not None:
-                feature_array[:, cat_idx] = grouped[cat].values
+        """
+        Count the calls in the csv file of a report and save the feature array
+        """
+        with open(
+            os.path.join(self.output_csv_dir, f"{file_name}.csv"),
+            "r",
+            newline="",
+            encoding="utf-8",
+        ) as input:
+            reader = csv.reader(input)
+            next(reader, None)  # skip header
+            rows = list(reader)
+        categories = [row[0] for row in rows]
+        times = [float(row[1]) for row in rows]
+        feature_array = self.build_feature_array(categories, times)
         np.save(os.path.join(self.output_npy_dir, f"{file_name}.npy"), feature_array)
 
+    def build_feature_array(self, categories, times):
+        """
+        Count the calls of each category in equal time intervals
+        """
+        return self.build_feature_arrays([(categories, times)])[0]
+
+    def build_feature_arrays(self, reports):
+        """
+        Count the calls of a batch of reports, a list of (categories, times),
+        at once. Return an array of shape (reports, time bins, categories).
+        """
+        codes = [encode_categories(c, self.category_table) for c, _ in reports]
+        times = [np.asarray(t, dtype=np.float64) for _, t in reports]
+        return bin_calls(
+            np.concatenate(codes) if codes else [],
+            np.concatenate(times) if times else [],
+            [len(t) for t in times],
+            self.num_time_bins,
+            len(self.category),
+        )
+
+    def count_calls(self, codes, times):
+        """
+        Count the encoded calls of a report in equal time intervals
+        """
+        return bin_calls(
+            codes, times, [len(codes)], self.num_time_bins, len(self.category)
+        )[0]
+
     def get_color(self, type, num):
         """
         Get the color of the call category
-        # TODO: Accelerate with numpy
-        """
-        if num == 0:
-            color = "#FFFFFF"
-        else:
-            with open(self.color_map, "r") as f:
-                color_map = ujson.load(f)
-                for key in reversed(color_map[type]):
-                    if num > int(key):
-                        color = color_map[type][key]
-                        break
-        return hex_to_rgb(color)
+        """
+        j = self.category.index(type)
+        index = np.count_nonzero(num > self.color_thresholds[j])
+        return tuple(int(c) for c in self.color_table[j, index])
+
+    def colorize(self, feature_array):
+        """
+        Colorize a feature array, or a batch of them, with the color lookup table
+        """
+        return colorize(feature_array, self.color_thresholds, self.color_table)
+
+    def render_image(self, feature_array):
+        """
+        Colorize the feature array (or a batch of them) and resize it to 224x224
+        """
+        image_data = self.colorize(feature_array)
+        # resize image from 16x16 to 224x224 (16x14=224)
+        return np.repeat(np.repeat(image_data, 14, axis=-3), 14, axis=-2)
 
     def generate_image(self, file_name):
         """
@@ -153,10 +326,40 @@ class ImageGenerator:
         input_file_path = os.path.join(self.output_npy_dir, f"{file_name}.npy")
         output_file_path = os.path.join(self.output_graph_dir, f"{file_name}.png")
         feature_array = np.load(input_file_path)
-        image_data = np.zeros((16, 16, 3), dtype=np.uint8)
-        for i in range(16):
-            for j in range(16):
-                image_data[i, j] = self.get_color(self.category[j], feature_array[i, j])
-        # resize image from 16x16 to 224x224 (16x14=224)
-        resized_image = np.repeat(np.repeat(image_data, 14, axis=0), 14, axis=1)
-        cv2.imwrite(output_file_path, resized_image)
+        cv2.imwrite(output_file_path, self.render_image(feature_array))
+
+    def process_report(self, file_name, keep_intermediate=False):
+        """
+        Generate the image straight from the report in a single pass
+
+        The csv and npy files are only written with keep_intermediate, e.g.
+        for debugging. Return the feature array.
+        """
+        input_file_path = find_report(self.input_dir, file_name)
+        # the calls are encoded while the report is parsed, never all kept
+        with metrics.timer("image_step_seconds", step="parse"):
+            with open_report(input_file_path) as input:
+                calls = iter_calls(input)
+                if keep_intermediate:
+                    output_file_path = os.path.join(
+                        self.output_csv_dir, f"{file_name}.csv"
+                    )
+                    with open(output_file_path, "w", newline="") as output:
+                        writer = csv.writer(output)
+                        writer.writerow(["category", "time"])
+                        codes, times = encode_calls(
+                            write_calls(writer, calls), self.category_table
+                        )
+                else:
+                    codes, times = encode_calls(calls, self.category_table)
+        metrics.inc("report_calls_total", len(codes))
+        with metrics.timer("image_step_seconds", step="bin"):
+            feature_array = self.count_calls(codes, times)
+        if keep_intermediate:
+            np.save(
+                os.path.join(self.output_npy_dir, f"{file_name}.npy"), feature_array
+            )
+        output_file_path = os.path.join(self.output_graph_dir, f"{file_name}.png")
+        with metrics.timer("image_step_seconds", step="render"):
+            cv2.imwrite(output_file_path, self.render_image(feature_array))
+        return feature_array
@@ -0,0 +1,296 @@
+"""
+Classify new sandbox reports with a trained checkpoint over local HTTP.
+
+Usage:
+    python inferenceService.py model/20240101_0000/epoch_10.pth --port 8000
+
+    POST /predict  {"report": "json/<sample>.json"} or {"features": [[...]]}
+    GET  /metrics
+"""
+
+import argparse
+import collections
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import ijson
+import numpy as np
+import torch
+import ujson
+from imageGenerator import ImageGenerator, encode_calls, iter_calls
+from malwareClassification import ENGINES
+from utils import open_report
+from VGG16 import INPUT_SIZE
+
+
+class InferenceService:
+    """
+    Serve a checkpoint saved by VGG16.saveModel (or another engine), loaded
+    once.
+
+    Concurrent requests are queued and classified together: a batch closes
+    when it reaches max_batch_size or when its first request has waited
+    max_latency sec, whichever comes first.
+    """
+
+    def __init__(
+        self,
+        checkpoint_path,
+        color_map,
+        classes=None,
+        max_batch_size=32,
+        max_latency=0.01,
+        execution_mode=None,
+        window=10000,
+        engine="vgg16",
+        model_cache=None,
+    ):
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.classifier = ENGINES[engine](
+            max_batch_size,
+            0,
+            "counts",
+            **(execution_mode or {}),
+            model_cache=model_cache,
+        )
+        self.classifier.color_map = color_map
+        self.classifier.loadModel(checkpoint_path)
+        self.classifier.network.eval()
+        # family names of the outputs, older checkpoints need them passed
+        checkpoint = torch.load(checkpoint_path, map_location="cpu", mmap=True)
+        self.classes = checkpoint.get("classes") or classes
+        if self.classes is None:
+            raise ValueError("The checkpoint has no classes, pass them explicitly.")
+        # reports are turned into feature arrays the same way as in preprocess
+        self.image_generator = ImageGenerator(
+            None, None, None, None, color_map, INPUT_SIZE["counts"][0]
+        )
+        self.requests = queue.Queue()
+        # metrics over the last window requests / batches
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.num_requests = 0
+        self.num_errors = 0
+        self.request_times = collections.deque(maxlen=window)
+        self.latencies = collections.deque(maxlen=window)
+        self.batch_sizes = collections.deque(maxlen=window)
+        self.worker = threading.Thread(target=self.run_batches, daemon=True)
+        self.worker.start()
+
+    def get_feature_array(self, report_path):
+        """
+        Build the feature array of a report file.
+        """
+        with open_report(report_path) as report:
+            codes, times = encode_calls(
+                iter_calls(report), self.image_generator.category_table
+            )
+        return self.image_generator.count_calls(codes, times)
+
+    def check_feature_array(self, feature_array):
+        """
+        Convert a feature array to float32, raise ValueError if its shape is
+        not the one of the model.
+        """
+        feature_array = np.asarray(feature_array, dtype=np.float32)
+        if feature_array.shape != INPUT_SIZE["counts"]:
+            raise ValueError(
+                f"Feature array of shape {feature_array.shape}, "
+                f"expected {INPUT_SIZE['counts']}."
+            )
+        return feature_array
+
+    def check_execution_mode(self, feature_arrays, tolerance=0.01):
+        """
+        Before any request, check the execution mode against fp32 on feature
+        arrays, e.g. the reports to classify, and fall back to fp32 if it
+        changes the class of more than tolerance of them.
+        """
+        x = torch.from_numpy(
+            np.stack([self.check_feature_array(fa) for fa in feature_arrays])
+        )
+        return self.classifier.checkExecutionMode(tolerance, x)
+
+    def predict(self, feature_array):
+        """
+        Queue a feature array and wait for its family probabilities.
+        """
+        feature_array = self.check_feature_array(feature_array)
+        future = Future()
+        self.requests.put((time.time(), feature_array, future))
+        return future.result()
+
+    def next_batch(self):
+        """
+        Wait for a request, then collect more until the batch is full or the
+        latency budget of the first one is spent.
+        """
+        batch = [self.requests.get()]
+        deadline = batch[0][0] + self.max_latency
+        while len(batch) < self.max_batch_size:
+            # past the deadline, still take the requests already queued
+            timeout = max(0, deadline - time.time())
+            try:
+                batch.append(self.requests.get(block=timeout > 0, timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def run_batches(self):
+        """
+        Classify the queued requests batch by batch.
+        """
+        while True:
+            batch = self.next_batch()
+            try:
+                x = torch.from_numpy(np.stack([fa for _, fa, _ in batch]))
+                with torch.inference_mode():
+                    output = self.classifier.forward(x.to(self.classifier.device))
+                # the classifier has 25 outputs, only the trained families count
+                output = output[:, : len(self.classes)].softmax(dim=1).cpu()
+            except Exception as e:
+                for _, _, future in batch:
+                    future.set_exception(e)
+                continue
+            end_time = time.time()
+            with self.lock:
+                self.batch_sizes.append(len(batch))
+                for start_time, _, _ in batch:
+                    self.request_times.append(end_time)
+                    self.latencies.append(end_time - start_time)
+            for (_, _, future), probabilities in zip(batch, output.tolist()):
+                future.set_result(dict(zip(self.classes, probabilities)))
+
+    def get_metrics(self):
+        """
+        Get the request rate, batch sizes and latency percentiles.
+        """
+        now = time.time()
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000
+            batch_sizes = np.array(self.batch_sizes)
+            recent = sum(1 for t in self.request_times if t > now - 60)
+            metrics = {
+                "uptime": now - self.start_time,
+                "requests": self.num_requests,
+                "errors": self.num_errors,
+                "requests_per_sec": self.num_requests / (now - self.start_time),
+                "requests_per_sec_1m": recent / min(60, now - self.start_time),
+                "batches": len(batch_sizes),
+                "queued": self.requests.qsize(),
+            }
+        if len(batch_sizes):
+            metrics["batch_size_mean"] = float(batch_sizes.mean())
+            metrics["batch_size_max"] = int(batch_sizes.max())
+        if len(latencies):
+            for p in (50, 95, 99):
+                metrics[f"latency_p{p}_ms"] = float(np.percentile(latencies, p))
+        return metrics
+
+    def serve(self, host="127.0.0.1", port=8000):
+        """
+        Serve /predict and /metrics until interrupted.
+        """
+        server = ThreadingHTTPServer((host, port), make_handler(self))
+        server.daemon_threads = True
+        print(f"Serving {len(self.classes)} families on http://{host}:{port}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+
+
+def make_handler(service):
+    """
+    Make the HTTP request handler of a service.
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        def send_json(self, status, body):
+            body = ujson.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_json(404, {"error": "not found"})
+                return
+            self.send_json(200, service.get_metrics())
+
+        def send_error_json(self, status, e):
+            with service.lock:
+                service.num_errors += 1
+            self.send_json(status, {"error": f"{type(e).__name__}: {e}"})
+
+        def do_POST(self):
+            if self.path != "/predict":
+                self.send_json(404, {"error": "not found"})
+                return
+            with service.lock:
+                service.num_requests += 1
+            # a bad request, or a report that cannot be read, is a 400
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                request = ujson.loads(self.rfile.read(length))
+                if not isinstance(request, dict):
+                    raise TypeError("The request is not a JSON object.")
+                if "features" in request:
+                    feature_array = request["features"]
+                else:
+                    report = request["report"]
+                    if not isinstance(report, str):
+                        raise TypeError("The report is not a path.")
+                    feature_array = service.get_feature_array(report)
+                feature_array = service.check_feature_array(feature_array)
+            except (KeyError, OSError, TypeError, ValueError, ijson.JSONError) as e:
+                self.send_error_json(400, e)
+                return
+            # anything else, e.g. a failure of the model, is a 500
+            try:
+                probabilities = service.predict(feature_array)
+            except Exception as e:
+                self.send_error_json(500, e)
+                return
+            family = max(probabilities, key=probabilities.get)
+            self.send_json(200, {"family": family, "probabilities": probabilities})
+
+        def log_message(self, format, *args):
+            # keep the console for the service, not every request
+            pass
+
+    return Handler
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("checkpoint")
+    parser.add_argument("--color-map", default="APIColorMappingRule.json")
+    parser.add_argument("--classes", nargs="+", help="for checkpoints without them")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--max-batch-size", type=int, default=32)
+    parser.add_argument("--max-latency", type=float, default=0.01, help="sec")
+    parser.add_argument("--precision", default="fp32", choices=["fp32", "bf16"])
+    parser.add_argument("--engine", default="vgg16", choices=list(ENGINES))
+    parser.add_argument("--model-cache", help="directory caching the base model")
+    args = parser.parse_args()
+    service = InferenceService(
+        args.checkpoint,
+        args.color_map,
+        args.classes,
+        args.max_batch_size,
+        args.max_latency,
+        {"precision": args.precision},
+        engine=args.engine,
+        model_cache=args.model_cache,
+    )
+    service.serve(args.host, args.port)
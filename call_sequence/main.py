@@ -1,10 +1,23 @@
+"""
+Malware classification from the API calls of sandbox reports.
+
+Usage:
+    python main.py                  # preprocess, then train
+    python main.py preprocess
+    python main.py train --epochs 10 --summary
+    python main.py validate model/20240101_0000/epoch_10.pth
+    python main.py predict model/20240101_0000/epoch_10.pth json/<sample>.json
+    torchrun --standalone --nproc_per_node 4 main.py train
+
+torch and the model are only imported by the subcommands that need them.
+"""
+
+import argparse
 import csv
 import os
 import time
 
-import pandas as pd
-from malwareClassification import MalwareClassification
-from preprocess import Preprocess
+from metrics import metrics
 
 """
 Set the parameters
@@ -20,77 +33,239 @@ JSON_PATH = "json"
 CSV_PATH = "csv"
 NPY_PATH = "npy"
 GRAPH_PATH = "graph"
+ANALYSIS_HISTORY = "analysis_history.json"
+MANIFEST_PATH = "manifest.sqlite"  # completed stages of every sample
+REPORT_STORE = "report_store"  # reports by SHA-256 of the sample, None to disable
+FEATURE_STORE = "features"  # packed feature arrays, set None to only keep images
 # output path: malware classification
 MODEL_DIR = "model"
+ACTIVATION_CACHE = "activation_cache"  # frozen layer outputs, None to disable
+MODEL_CACHE = "model_cache"  # customized pretrained VGG16, None to disable
+# output path: stage timings and throughput, as JSON lines and for Prometheus
+METRICS_LOG = "metrics.jsonl"
+METRICS_PROM = "metrics.prom"
 # api token
 API_TOKEN = "API_TOKEN"  # replace with your own API token
+SANDBOX_URL = "http://localhost:8090"  # or a mockSandbox.py for load tests
+# several sandbox hosts, each with its own token and number of samples at once,
+# e.g. [{"url": "http://10.0.0.2:8090", "token": "API_TOKEN", "limit": 4}, ...]
+SANDBOX_NODES = None  # None to only use SANDBOX_URL with MAX_IN_FLIGHT
 # dynamic analysis wait time (sec)
-BASE_TIME = 100  # at least wait for BASE_TIME sec
-REQUEST_INTERVAL = 2  # then check if it is finished every REQUEST_INTERVAL sec
+BASE_TIME = 100  # first check after BASE_TIME sec, until past runs give a better guess
+REQUEST_INTERVAL = 2  # then check the task status, doubling the interval each time
 MAX_WAIT_TIME = 300  # if wait over MAX_WAIT_TIME sec, skip
+MAX_REQUEST_INTERVAL = 30  # upper bound of the interval between two checks
+SUBMIT_DELAY = 1  # pause after each submission
+MAX_IN_FLIGHT = 1  # number of samples analyzed by the sandbox at the same time
+REPORT_COMPRESSION = None  # compress the saved reports: None, "gzip" or "zstd"
+# image generation: go from report to image in one pass, optionally keeping csv/npy
+FUSED_PIPELINE = True
+KEEP_INTERMEDIATE = False
+NUM_WORKERS = os.cpu_count()  # processes generating the images
+NUM_TIME_BINS = 16  # equal time intervals of the feature array
 # balance the number of the sample in every family
 NUM_OF_EACH_FAMILY = 10
 # hyperparameters
 batch_size = 8
 learning_rate = 1e-3
+# classifier: "vgg16", or "counts" for a small model on the count matrices,
+# which needs FEATURE_STORE and the "counts" input mode
+ENGINE = "vgg16"
+# "image" trains from the images, "compact"/"counts" need FEATURE_STORE
+INPUT_MODE = "counts" if FEATURE_STORE else "image"
+# data loader: num_workers "auto" sizes it by the free cores
+LOADER_SETTINGS = {
+    "num_workers": "auto",
+    "pin_memory": None,  # None pins memory when training on GPU
+    "prefetch_factor": 4,
+    "persistent_workers": True,
+}
+# execution mode, set per run by environment variables, e.g. VGG16_PRECISION=bf16
+EXECUTION_MODE = {
+    "precision": os.environ.get("VGG16_PRECISION", "fp32"),  # "fp32" or "bf16"
+    "channels_last": os.environ.get("VGG16_CHANNELS_LAST") == "1",
+    "compile": os.environ.get("VGG16_COMPILE") == "1",
+}
+# checkpoints: "lean" only saves the trained layers, written in the background;
+# keep the keep_last newest (None for all) and the keep_best most accurate
+CHECKPOINT_SETTINGS = {
+    "checkpoint_mode": "lean",
+    "keep_last": 3,
+    "keep_best": 1,
+}
+# data-parallel training when launched with torchrun, see distributedTraining.py
+DISTRIBUTED = True
 train_ratio = 0.8
 epochs = 10
 
-"""
-Preprocess: Dynamic analysis and generate image
-"""
-preprocess = Preprocess(
-    DATASET_DIR,
-    SAMPLE_FOLDER,
-    DATA_DESCRIPTION,
-    COLOR_MAP,
-    JSON_PATH,
-    CSV_PATH,
-    NPY_PATH,
-    GRAPH_PATH,
-    API_TOKEN,
-    BASE_TIME,
-    REQUEST_INTERVAL,
-    MAX_WAIT_TIME,
-    NUM_OF_EACH_FAMILY,
-)
-# create the output directories
-preprocess.mkdir()
-# dynamic analysis
-preprocess.dynamic_analysis()
-# generate image
-preprocess.generate_image()
 
+def run_preprocess():
+    """
+    Preprocess: Dynamic analysis and generate image
+    """
+    from preprocess import Preprocess
 
-"""
-Malware Classification: Train the model
-"""
-# mkdir for model
-os.makedirs(MODEL_DIR, exist_ok=True)
-# set the path
-t = time.localtime()
-MODEL_PATH = os.path.join(MODEL_DIR, time.strftime("%Y%m%d_%H%M", t))
-LOG_PATH = os.path.join(MODEL_PATH, "log.txt")
-############################################
-# TODO: wait for reorganize
-malwareClassification = MalwareClassification(
-    GRAPH_PATH, MODEL_PATH, LOG_PATH, batch_size, learning_rate
-)
-# read selected families
-selected = pd.read_csv(os.path.join(DATASET_DIR, SELECTED_FAMILY))
-with open(os.path.join(DATASET_DIR, DATA_DESCRIPTION), "r", newline="") as csvfile:
-    rows = csv.reader(csvfile)
-    next(rows)  # skip header
-    for row in rows:
-        if row[1] not in selected["family"].values:  # skip unwanted families
-            continue
-        # create a dictionary with family name as key and path as value
-        malwareClassification.label_file[row[0]] = os.path.join(GRAPH_PATH, row[1])
-# create directories for each family
-for i in malwareClassification.label_file.keys():
-    os.makedirs(malwareClassification.label_file[i], exist_ok=True)
-# move graphs to family folders
-"""from util_for_connect_two_projects import move_graph_to_family_folder
-move_graph_to_family_folder(os.path.join(DATASET_DIR, DATA_DESCRIPTION), GRAPH_PATH)"""
-malwareClassification.setModel(train_ratio)
-malwareClassification.trainModel(epochs)
+    preprocess = Preprocess(
+        DATASET_DIR,
+        SAMPLE_FOLDER,
+        DATA_DESCRIPTION,
+        COLOR_MAP,
+        JSON_PATH,
+        CSV_PATH,
+        NPY_PATH,
+        GRAPH_PATH,
+        API_TOKEN,
+        BASE_TIME,
+        REQUEST_INTERVAL,
+        MAX_WAIT_TIME,
+        NUM_OF_EACH_FAMILY,
+        MAX_IN_FLIGHT,
+        ANALYSIS_HISTORY,
+        REPORT_COMPRESSION,
+        NUM_WORKERS,
+        MANIFEST_PATH,
+        NUM_TIME_BINS,
+        FEATURE_STORE,
+        SANDBOX_URL,
+        REPORT_STORE,
+        SANDBOX_NODES,
+        MAX_REQUEST_INTERVAL,
+        SUBMIT_DELAY,
+    )
+    # create the output directories
+    preprocess.mkdir()
+    # dynamic analysis
+    preprocess.dynamic_analysis()
+    # generate image
+    preprocess.generate_image(FUSED_PIPELINE, KEEP_INTERMEDIATE)
+
+
+def load_selected_families():
+    """
+    Read the selected families.
+    """
+    with open(os.path.join(DATASET_DIR, SELECTED_FAMILY), "r", newline="") as f:
+        return [row["family"] for row in csv.DictReader(f)]
+
+
+def make_classification(model_path=None, log_path=None, model_summary=False):
+    """
+    Set up the malware classification, from the feature store if there is
+    one, otherwise from the images.
+    """
+    from malwareClassification import MalwareClassification
+
+    return MalwareClassification(
+        FEATURE_STORE or GRAPH_PATH,
+        model_path,
+        log_path,
+        batch_size,
+        learning_rate,
+        COLOR_MAP,
+        load_selected_families(),
+        INPUT_MODE,
+        LOADER_SETTINGS,
+        ACTIVATION_CACHE,
+        EXECUTION_MODE,
+        ENGINE,
+        CHECKPOINT_SETTINGS,
+        MODEL_CACHE,
+        model_summary,
+        DISTRIBUTED,
+    )
+
+
+def run_train(epochs, pretrained=None, model_summary=False):
+    """
+    Malware Classification: Train the model
+    """
+    # mkdir for model
+    os.makedirs(MODEL_DIR, exist_ok=True)
+    # set the path
+    t = time.localtime()
+    model_path = os.path.join(MODEL_DIR, time.strftime("%Y%m%d_%H%M", t))
+    log_path = os.path.join(model_path, "log.txt")
+    ############################################
+    # TODO: wait for reorganize
+    malwareClassification = make_classification(model_path, log_path, model_summary)
+    selected = set(malwareClassification.families)
+    with open(os.path.join(DATASET_DIR, DATA_DESCRIPTION), "r", newline="") as csvfile:
+        rows = csv.reader(csvfile)
+        next(rows)  # skip header
+        for row in rows:
+            if row[1] not in selected:  # skip unwanted families
+                continue
+            # create a dictionary with family name as key and path as value
+            malwareClassification.label_file[row[0]] = os.path.join(GRAPH_PATH, row[1])
+    # create directories for each family
+    for i in malwareClassification.label_file.keys():
+        os.makedirs(malwareClassification.label_file[i], exist_ok=True)
+    # move graphs to family folders
+    """from util_for_connect_two_projects import move_graph_to_family_folder
+    move_graph_to_family_folder(os.path.join(DATASET_DIR, DATA_DESCRIPTION), GRAPH_PATH)"""
+    malwareClassification.setModel(train_ratio, pretrained)
+    malwareClassification.trainModel(epochs)
+    malwareClassification.close()
+
+
+def run_validate(checkpoint, model_summary=False):
+    """
+    Validate a checkpoint on all the samples.
+    """
+    malwareClassification = make_classification(model_summary=model_summary)
+    malwareClassification.validateModel(checkpoint)
+    malwareClassification.close()
+
+
+def run_predict(checkpoint, reports):
+    """
+    Classify sandbox reports with a checkpoint.
+    """
+    from inferenceService import InferenceService
+
+    service = InferenceService(
+        checkpoint,
+        COLOR_MAP,
+        execution_mode=EXECUTION_MODE,
+        engine=ENGINE,
+        model_cache=MODEL_CACHE,
+    )
+    feature_arrays = [service.get_feature_array(report) for report in reports]
+    service.check_execution_mode(feature_arrays)
+    for report, feature_array in zip(reports, feature_arrays):
+        probabilities = service.predict(feature_array)
+        family = max(probabilities, key=probabilities.get)
+        print("%s: %s (%.3f)" % (report, family, probabilities[family]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.add_parser("preprocess", help="dynamic analysis and images")
+    train_parser = subparsers.add_parser("train", help="train the model")
+    train_parser.add_argument("--epochs", type=int, default=epochs)
+    train_parser.add_argument("--pretrained", help="checkpoint to start from")
+    validate_parser = subparsers.add_parser("validate", help="validate a checkpoint")
+    validate_parser.add_argument("checkpoint")
+    for subparser in (train_parser, validate_parser):
+        subparser.add_argument(
+            "--summary", action="store_true", help="print the model summary"
+        )
+    predict_parser = subparsers.add_parser("predict", help="classify reports")
+    predict_parser.add_argument("checkpoint")
+    predict_parser.add_argument("reports", nargs="+")
+    args = parser.parse_args()
+
+    # with torchrun, only rank 0 writes the metrics
+    if int(os.environ.get("RANK", 0)) == 0:
+        metrics.configure(METRICS_LOG, METRICS_PROM)
+    if args.command in (None, "preprocess"):
+        run_preprocess()
+    if args.command is None:
+        run_train(epochs)
+    elif args.command == "train":
+        run_train(args.epochs, args.pretrained, args.summary)
+    elif args.command == "validate":
+        run_validate(args.checkpoint, args.summary)
+    elif args.command == "predict":
+        run_predict(args.checkpoint, args.reports)
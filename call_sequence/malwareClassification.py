@@ -1,5 +1,13 @@
+from countClassifier import CountClassifier
+from distributedTraining import cleanup, print_main
 from VGG16 import VGG16
 
+# classifier engines, "counts" trains on the count matrices of a feature store
+ENGINES = {
+    "vgg16": VGG16,
+    "counts": CountClassifier,
+}
+
 
 class MalwareClassification:
     def __init__(
@@ -9,13 +17,39 @@ class MalwareClassification:
         log_path,
         batch_size,
         learning_rate,
+        color_map=None,
+        families=None,
+        input_mode="image",
+        loader_settings=None,
+        activation_cache=None,
+        execution_mode=None,
+        engine="vgg16",
+        checkpoint_settings=None,
+        model_cache=None,
+        model_summary=False,
+        distributed=False,
     ) -> None:
-        print("Intializing Malware Classification.")
+        print_main("Intializing Malware Classification.")
 
-        self.vgg16 = VGG16(batch_size, learning_rate)
+        self.classifier = ENGINES[engine](
+            batch_size,
+            learning_rate,
+            input_mode,
+            **(loader_settings or {}),
+            **(execution_mode or {}),
+            **(checkpoint_settings or {}),
+            model_cache=model_cache,
+            model_summary=model_summary,
+            distributed=distributed,
+        )
         self.image_path = image_path
         self.model_path = model_path
         self.log_path = log_path
+        # only needed when training from a feature store
+        self.color_map = color_map
+        self.families = families
+        # directory caching the activations of the frozen layers, or None
+        self.activation_cache = activation_cache
 
         self.label_file = {}
 
@@ -23,22 +57,43 @@ class MalwareClassification:
         """
         Set model for malware classification.
         """
-        print("Setting model for malware classification.")
+        print_main("Setting model for malware classification.")
 
-        self.vgg16.loadData(self.image_path)
-        self.vgg16.splitTrainData(train_ratio)
-        self.vgg16.loadModel(pretrained)
+        self.classifier.loadData(self.image_path, self.color_map, self.families)
+        self.classifier.splitTrainData(train_ratio)
+        self.classifier.loadModel(pretrained)
+        if self.activation_cache is not None:
+            self.classifier.cacheActivations(self.activation_cache)
 
     def trainModel(self, epochs):
         """
         Train the model.
         """
-        print("Training the model.")
+        print_main("Training the model.")
 
-        train_acc, test_acc, train_loss, test_loss = self.vgg16.trainModel(
+        train_acc, test_acc, train_loss, test_loss = self.classifier.trainModel(
             epochs, self.model_path, self.log_path
         )
-        print("Training accuracy: ", train_acc)
-        print("Testing accuracy: ", test_acc)
-        print("Training loss: ", train_loss)
-        print("Testing loss: ", test_loss)
+        print_main("Training accuracy: ", train_acc)
+        print_main("Testing accuracy: ", test_acc)
+        print_main("Training loss: ", train_loss)
+        print_main("Testing loss: ", test_loss)
+
+    def validateModel(self, pretrained):
+        """
+        Validate a trained model on all the samples.
+        """
+        print_main("Validating the model.")
+
+        self.classifier.loadData(self.image_path, self.color_map, self.families)
+        self.classifier.setValidationData()
+        self.classifier.loadModel(pretrained)
+        # make sure the execution mode does not cost accuracy
+        self.classifier.checkExecutionMode()
+        return self.classifier.validateModel()
+
+    def close(self):
+        """
+        Leave the process group, when distributed.
+        """
+        cleanup()
@@ -0,0 +1,129 @@
+import hashlib
+import sqlite3
+
+
+def hash_file(path, chunk_size=1 << 20):
+    """
+    Get the SHA-256 of a file.
+    """
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+class Manifest:
+    """
+    Persistent record of the samples and the stages they completed.
+
+    Each stage is recorded with a version string of the parameters it was run
+    with, so a stage counts as done only if the version still matches.
+    """
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS samples (
+                name TEXT PRIMARY KEY,
+                sha256 TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS stages (
+                name TEXT NOT NULL,
+                stage TEXT NOT NULL,
+                version TEXT NOT NULL,
+                PRIMARY KEY (name, stage)
+            );
+            CREATE INDEX IF NOT EXISTS samples_sha256 ON samples (sha256);
+            CREATE TABLE IF NOT EXISTS analyses (
+                sha256 TEXT PRIMARY KEY,
+                seconds REAL NOT NULL
+            );
+            """)
+        # keep the stages in memory, so a resume check is a dict lookup
+        self.stages = {
+            (name, stage): version
+            for name, stage, version in self.connection.execute(
+                "SELECT name, stage, version FROM stages"
+            )
+        }
+
+    def is_done(self, name, stage, version=""):
+        """
+        Check if the stage of a sample is done with the given version.
+        """
+        return self.stages.get((name, stage)) == version
+
+    def mark_done(self, name, stage, version=""):
+        """
+        Record that the stage of a sample is done, call commit to persist it.
+        """
+        self.stages[(name, stage)] = version
+        self.connection.execute(
+            "INSERT OR REPLACE INTO stages (name, stage, version) VALUES (?, ?, ?)",
+            (name, stage, version),
+        )
+
+    def get_done(self, stage, version=""):
+        """
+        Get the names of the samples whose stage is done with the given version.
+        """
+        return sorted(
+            name
+            for (name, done_stage), done_version in self.stages.items()
+            if done_stage == stage and done_version == version
+        )
+
+    def set_hash(self, name, sha256):
+        """
+        Record the SHA-256 of a sample.
+        """
+        self.connection.execute(
+            "INSERT OR REPLACE INTO samples (name, sha256) VALUES (?, ?)",
+            (name, sha256),
+        )
+
+    def get_hash(self, name):
+        """
+        Get the SHA-256 of a sample, or None if it is not recorded.
+        """
+        row = self.connection.execute(
+            "SELECT sha256 FROM samples WHERE name = ?", (name,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def get_names(self, sha256):
+        """
+        Get the names of the samples with the given SHA-256, sorted.
+        """
+        return [
+            name
+            for (name,) in self.connection.execute(
+                "SELECT name FROM samples WHERE sha256 = ? ORDER BY name", (sha256,)
+            )
+        ]
+
+    def set_analysis_time(self, sha256, seconds):
+        """
+        Record how long the sandbox took to analyze a sample, in sec.
+        """
+        self.connection.execute(
+            "INSERT OR REPLACE INTO analyses (sha256, seconds) VALUES (?, ?)",
+            (sha256, seconds),
+        )
+
+    def get_analysis_time(self, sha256):
+        """
+        Get how long the sandbox took to analyze a sample, or None.
+        """
+        row = self.connection.execute(
+            "SELECT seconds FROM analyses WHERE sha256 = ?", (sha256,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def commit(self):
+        self.connection.commit()
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
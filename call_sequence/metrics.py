@@ -0,0 +1,170 @@
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+
+import ujson
+
+
+class Metrics:
+    """
+    Counters, gauges and timings of a run, shared by all the stages.
+
+    Events (a finished stage, an epoch) are appended to a JSON-lines file as
+    they happen, and write() dumps every series to a Prometheus text file.
+    Nothing is written until configure() gives the paths.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.jsonl_path = None
+        self.prometheus_path = None
+        # (name, labels) -> value, or [count, sum, max] for the summaries
+        self.counters = {}
+        self.gauges = {}
+        self.summaries = {}
+
+    def configure(self, jsonl_path=None, prometheus_path=None):
+        """
+        Set the output files, either can be None.
+        """
+        self.jsonl_path = jsonl_path
+        self.prometheus_path = prometheus_path
+
+    def inc(self, name, value=1, **labels):
+        """
+        Increase a counter.
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        """
+        Set a gauge.
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.gauges[key] = value
+
+    def observe(self, name, value, **labels):
+        """
+        Add an observation, e.g. a duration in sec, to a summary.
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            summary = self.summaries.setdefault(key, [0, 0.0, value])
+            summary[0] += 1
+            summary[1] += value
+            summary[2] = max(summary[2], value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """
+        Time a block into the summary name, in sec.
+        """
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start_time, **labels)
+
+    def log(self, event, **fields):
+        """
+        Append an event to the JSON-lines file.
+        """
+        if self.jsonl_path is None:
+            return
+        line = ujson.dumps({"time": time.time(), "event": event, **fields})
+        with self.lock, open(self.jsonl_path, "a") as f:
+            f.write(line + "\n")
+
+    def drain(self):
+        """
+        Take the series recorded so far, e.g. to send them from a worker
+        process to the main one, which merges them.
+        """
+        with self.lock:
+            series = (self.counters, self.gauges, self.summaries)
+            self.counters, self.gauges, self.summaries = {}, {}, {}
+        return series
+
+    def merge(self, series):
+        """
+        Add the series drained from another process.
+        """
+        counters, gauges, summaries = series
+        with self.lock:
+            for key, value in counters.items():
+                self.counters[key] = self.counters.get(key, 0) + value
+            self.gauges.update(gauges)
+            for key, (count, total, maximum) in summaries.items():
+                summary = self.summaries.setdefault(key, [0, 0.0, maximum])
+                summary[0] += count
+                summary[1] += total
+                summary[2] = max(summary[2], maximum)
+
+    def record_peak_memory(self):
+        """
+        Record the peak resident memory of this process and of its finished
+        child processes, e.g. the image workers.
+        """
+        # ru_maxrss is in KiB on Linux
+        for process, who in (
+            ("main", resource.RUSAGE_SELF),
+            ("children", resource.RUSAGE_CHILDREN),
+        ):
+            peak = resource.getrusage(who).ru_maxrss * 1024
+            self.set("peak_rss_bytes", peak, process=process)
+
+    def write(self):
+        """
+        Write every series to the Prometheus text file.
+        """
+        if self.prometheus_path is None:
+            return
+        self.record_peak_memory()
+        lines = []
+        with self.lock:
+            for kind, series in (("counter", self.counters), ("gauge", self.gauges)):
+                for name in sorted({name for name, _ in series}):
+                    lines.append(f"# TYPE {name} {kind}")
+                    for (key, labels), value in sorted(series.items()):
+                        if key == name:
+                            lines.append(f"{name}{format_labels(labels)} {value}")
+            for name in sorted({name for name, _ in self.summaries}):
+                summaries = sorted(
+                    (format_labels(labels), summary)
+                    for (key, labels), summary in self.summaries.items()
+                    if key == name
+                )
+                lines.append(f"# TYPE {name} summary")
+                for labels, (count, total, _) in summaries:
+                    lines.append(f"{name}_count{labels} {count}")
+                    lines.append(f"{name}_sum{labels} {total}")
+                # a summary only has _count and _sum, the max is its own gauge
+                lines.append(f"# TYPE {name}_max gauge")
+                for labels, (_, _, maximum) in summaries:
+                    lines.append(f"{name}_max{labels} {maximum}")
+        # replace the file at once, so a scraper never reads half of it
+        with open(self.prometheus_path + ".part", "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(self.prometheus_path + ".part", self.prometheus_path)
+
+
+def format_labels(labels):
+    """
+    Format labels, a tuple of (name, value), as Prometheus labels.
+    """
+    if not labels:
+        return ""
+    labels = ",".join(
+        '%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for name, value in labels
+    )
+    return "{" + labels + "}"
+
+
+# metrics of this process, shared by all the modules
+metrics = Metrics()
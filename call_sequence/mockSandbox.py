@@ -0,0 +1,392 @@
+"""
+Local stand-in of the sandbox API, to load-test the dynamic analysis offline.
+
+Usage:
+    python mockSandbox.py serve --port 8090 --duration uniform:60,180 --time-scale 0.01
+    python mockSandbox.py loadtest --samples 200 --max-in-flight 8 --time-scale 0.01
+    python mockSandbox.py loadtest --samples 200 --max-in-flight 8 --nodes 4 --time-scale 0.01
+
+Distributions are given as fixed:<value>, uniform:<low>,<high>,
+lognormal:<median>,<sigma> or exponential:<mean>. Durations are in sandbox
+sec, which time_scale turns into wall sec, e.g. 0.01 runs 100 times faster.
+"""
+
+import argparse
+import heapq
+import math
+import os
+import random
+import re
+import shutil
+import tempfile
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import ujson
+from preprocess import Preprocess
+from syntheticReport import write_synthetic_report
+from utils import list_reports
+
+
+def parse_distribution(spec):
+    """
+    Parse a distribution spec into a function drawing a value with an rng.
+    """
+    kind, _, args = spec.partition(":")
+    args = [float(arg) for arg in args.split(",") if arg]
+    if kind == "fixed":
+        return lambda rng: args[0]
+    if kind == "uniform":
+        return lambda rng: rng.uniform(args[0], args[1])
+    if kind == "lognormal":
+        return lambda rng: rng.lognormvariate(math.log(args[0]), args[1])
+    if kind == "exponential":
+        return lambda rng: rng.expovariate(1 / args[0])
+    raise ValueError(f"Unknown distribution: {spec}")
+
+
+class MockSandbox:
+    """
+    Tasks are analyzed by a fixed number of machines, in the order they are
+    created, for a duration drawn from the duration distribution. The task
+    status is derived from the clock: "pending" while queued, "running",
+    then "reported" or "failed_analysis".
+    """
+
+    def __init__(
+        self,
+        duration="uniform:60,180",
+        failure_rate=0.0,
+        latency="fixed:0",
+        error_rate=0.0,
+        report_calls="uniform:5000,50000",
+        machines=4,
+        time_scale=1.0,
+        seed=0,
+    ):
+        self.duration = parse_distribution(duration)
+        # share of the analyses that fail
+        self.failure_rate = failure_rate
+        # added to every HTTP response, in wall sec
+        self.latency = parse_distribution(latency)
+        # share of the HTTP requests answered with a 500
+        self.error_rate = error_rate
+        # number of API calls in a report, i.e. the report size
+        self.report_calls = parse_distribution(report_calls)
+        self.time_scale = time_scale
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.tasks = {}
+        self.next_task_id = 1
+        # time each machine becomes free
+        self.machines = [0.0] * machines
+        self.report_dir = tempfile.mkdtemp(prefix="mock_sandbox_")
+        self.stats = {"created": 0, "reports": 0, "deleted": 0, "errors": 0}
+
+    def create_task(self, sample_size):
+        """
+        Queue a task on the first free machine, return its id.
+        """
+        with self.lock:
+            task_id = self.next_task_id
+            self.next_task_id += 1
+            now = time.time()
+            duration = self.duration(self.rng) * self.time_scale
+            started_on = max(now, heapq.heappop(self.machines))
+            completed_on = started_on + duration
+            heapq.heappush(self.machines, completed_on)
+            self.tasks[task_id] = {
+                "id": task_id,
+                "sample_size": sample_size,
+                "added_on": now,
+                "started_on": started_on,
+                "completed_on": completed_on,
+                "failed": self.rng.random() < self.failure_rate,
+                "calls": int(self.report_calls(self.rng)),
+            }
+            self.stats["created"] += 1
+            return task_id
+
+    def get_task(self, task_id):
+        """
+        Get the task as the sandbox reports it, or None.
+        """
+        with self.lock:
+            task = self.tasks.get(task_id)
+        if task is None:
+            return None
+        now = time.time()
+        if now < task["started_on"]:
+            status = "pending"
+        elif now < task["completed_on"]:
+            status = "running"
+        else:
+            status = "failed_analysis" if task["failed"] else "reported"
+        view = {"id": task_id, "status": status}
+        for key in ("added_on", "started_on", "completed_on"):
+            if task[key] <= now:
+                view[key] = str(datetime.fromtimestamp(task[key]))
+        return view
+
+    def get_report_path(self, task_id):
+        """
+        Get the report of a reported task, written on first request, or None.
+        """
+        task = self.get_task(task_id)
+        if task is None or task["status"] != "reported":
+            return None
+        path = os.path.join(self.report_dir, f"{task_id}.json")
+        with self.lock:
+            if not os.path.exists(path):
+                write_synthetic_report(
+                    path + ".part", self.tasks[task_id]["calls"], seed=task_id
+                )
+                os.replace(path + ".part", path)
+            self.stats["reports"] += 1
+        return path
+
+    def delete_task(self, task_id):
+        """
+        Delete a task and its report, return whether it existed.
+        """
+        with self.lock:
+            task = self.tasks.pop(task_id, None)
+            if task is not None:
+                self.stats["deleted"] += 1
+        path = os.path.join(self.report_dir, f"{task_id}.json")
+        if os.path.exists(path):
+            os.remove(path)
+        return task is not None
+
+    def start(self, host="127.0.0.1", port=8090):
+        """
+        Serve the API in a background thread, return the server.
+        """
+        server = ThreadingHTTPServer((host, port), make_handler(self))
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+    def close(self):
+        shutil.rmtree(self.report_dir, ignore_errors=True)
+
+
+def make_handler(sandbox):
+    """
+    Make the HTTP request handler of a mock sandbox.
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        def send_json(self, status, body):
+            body = ujson.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def inject(self):
+            # latency and errors injected into every request
+            time.sleep(sandbox.latency(sandbox.rng))
+            if sandbox.rng.random() < sandbox.error_rate:
+                with sandbox.lock:
+                    sandbox.stats["errors"] += 1
+                self.send_json(500, {"error": "injected error"})
+                return True
+            return False
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            self.rfile.read(length)
+            if self.inject():
+                return
+            if self.path != "/tasks/create/file":
+                self.send_json(404, {"error": "not found"})
+                return
+            self.send_json(200, {"task_id": sandbox.create_task(length)})
+
+        def do_GET(self):
+            if self.inject():
+                return
+            match = re.fullmatch(r"/tasks/(view|report|delete)/(\d+)", self.path)
+            if match is None:
+                self.send_json(404, {"error": "not found"})
+                return
+            endpoint, task_id = match.group(1), int(match.group(2))
+            if endpoint == "view":
+                task = sandbox.get_task(task_id)
+                if task is None:
+                    self.send_json(404, {"error": "task not found"})
+                    return
+                self.send_json(200, {"task": task})
+            elif endpoint == "report":
+                path = sandbox.get_report_path(task_id)
+                if path is None:
+                    self.send_json(404, {"error": "report not found"})
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(os.path.getsize(path)))
+                self.end_headers()
+                with open(path, "rb") as f:
+                    shutil.copyfileobj(f, self.wfile)
+            elif sandbox.delete_task(task_id):
+                self.send_json(200, {"status": "OK"})
+            else:
+                self.send_json(404, {"error": "task not found"})
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def load_test(
+    sandbox,
+    num_samples,
+    max_in_flight,
+    base_time,
+    request_interval,
+    max_wait_time,
+    max_request_interval=30,
+    submit_delay=1,
+    num_families=4,
+    seed=0,
+):
+    """
+    Run Preprocess.dynamic_analysis on synthetic samples against a mock
+    sandbox, or a list of them used as a pool of nodes with max_in_flight
+    samples each, return the throughput in samples per hour of sandbox time.
+
+    The wait times are in sandbox sec, scaled the same way as the sandbox.
+    """
+    rng = random.Random(seed)
+    sandboxes = sandbox if isinstance(sandbox, list) else [sandbox]
+    servers = [sandbox.start(port=0) for sandbox in sandboxes]
+    nodes = [
+        {
+            "url": "http://%s:%d" % server.server_address,
+            "token": "API_TOKEN",
+            "limit": max_in_flight,
+        }
+        for server in servers
+    ]
+    tmp_dir = tempfile.mkdtemp(prefix="load_test_")
+    try:
+        sample_dir = os.path.join(tmp_dir, "malware")
+        os.makedirs(sample_dir)
+        with open(os.path.join(tmp_dir, "dataset.csv"), "w") as f:
+            f.write("name,label\n")
+            for i in range(num_samples):
+                name = "sample%05d.exe" % i
+                with open(os.path.join(sample_dir, name), "wb") as sample:
+                    sample.write(rng.randbytes(rng.randint(10_000, 200_000)))
+                f.write("%s,family%d\n" % (name, i % num_families))
+        json_dir = os.path.join(tmp_dir, "json")
+        os.makedirs(json_dir)
+        scale = sandboxes[0].time_scale
+        preprocess = Preprocess(
+            tmp_dir,
+            "malware",
+            "dataset.csv",
+            None,
+            json_dir,
+            None,
+            None,
+            None,
+            "API_TOKEN",
+            base_time * scale,
+            request_interval * scale,
+            max_wait_time * scale,
+            num_samples,
+            max_in_flight,
+            manifest_path=os.path.join(tmp_dir, "manifest.sqlite"),
+            sandbox_nodes=nodes,
+            max_request_interval=max_request_interval * scale,
+            submit_delay=submit_delay * scale,
+        )
+        start_time = time.time()
+        preprocess.dynamic_analysis()
+        elapsed = time.time() - start_time
+        reported = len(list_reports(json_dir))
+    finally:
+        for server in servers:
+            server.shutdown()
+            server.server_close()
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    samples_per_hour = reported / (elapsed / scale) * 3600
+    print(
+        "%d of %d samples reported in %.1f(secs), %.1f sandbox hours"
+        % (reported, num_samples, elapsed, elapsed / scale / 3600)
+    )
+    print("Throughput: %.1f samples/hour of sandbox time" % samples_per_hour)
+    for sandbox in sandboxes:
+        print("Sandbox:", sandbox.stats)
+    return samples_per_hour
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    serve_parser = subparsers.add_parser("serve", help="run the mock sandbox")
+    serve_parser.add_argument("--host", default="127.0.0.1")
+    serve_parser.add_argument("--port", type=int, default=8090)
+    loadtest_parser = subparsers.add_parser(
+        "loadtest", help="measure the dynamic analysis throughput"
+    )
+    loadtest_parser.add_argument("--samples", type=int, default=100)
+    loadtest_parser.add_argument("--max-in-flight", type=int, default=4)
+    loadtest_parser.add_argument("--base-time", type=float, default=100)
+    loadtest_parser.add_argument("--request-interval", type=float, default=2)
+    loadtest_parser.add_argument("--max-wait-time", type=float, default=300)
+    loadtest_parser.add_argument("--max-request-interval", type=float, default=30)
+    loadtest_parser.add_argument("--submit-delay", type=float, default=1)
+    loadtest_parser.add_argument(
+        "--nodes", type=int, default=1, help="sandboxes, max-in-flight samples each"
+    )
+    for subparser in (serve_parser, loadtest_parser):
+        subparser.add_argument("--duration", default="uniform:60,180")
+        subparser.add_argument("--failure-rate", type=float, default=0.0)
+        subparser.add_argument("--latency", default="fixed:0", help="wall sec")
+        subparser.add_argument("--error-rate", type=float, default=0.0)
+        subparser.add_argument("--report-calls", default="uniform:5000,50000")
+        subparser.add_argument("--machines", type=int, default=4)
+        subparser.add_argument("--time-scale", type=float, default=1.0)
+        subparser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    sandboxes = [
+        MockSandbox(
+            args.duration,
+            args.failure_rate,
+            args.latency,
+            args.error_rate,
+            args.report_calls,
+            args.machines,
+            args.time_scale,
+            args.seed + i,
+        )
+        for i in range(getattr(args, "nodes", 1))
+    ]
+    try:
+        if args.command == "serve":
+            sandboxes[0].start(args.host, args.port)
+            print(f"Mock sandbox on http://{args.host}:{args.port}")
+            threading.Event().wait()
+        else:
+            load_test(
+                sandboxes,
+                args.samples,
+                args.max_in_flight,
+                args.base_time,
+                args.request_interval,
+                args.max_wait_time,
+                args.max_request_interval,
+                args.submit_delay,
+            )
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for sandbox in sandboxes:
+            sandbox.close()
@@ -0,0 +1,218 @@
+"""
+Export a fine-tuned VGG16 checkpoint for CPU inference and benchmark it.
+
+Usage:
+    python modelExport.py model/20240101_0000/epoch_10.pth --store features
+
+Writes to --output-dir:
+    vgg16_fp32.pt          TorchScript, fp32
+    vgg16_fp32.onnx        ONNX, fp32
+    vgg16_int8_dynamic.pt  TorchScript, int8 Linear layers (dynamic quantization)
+    vgg16_int8_static.pt   TorchScript, int8 conv and Linear layers, calibrated
+                           on the feature store (static quantization)
+All of them take the raw 16x16 count matrices, batched.
+"""
+
+import argparse
+import copy
+import inspect
+import os
+import time
+
+import numpy as np
+import torch
+from torch.ao.quantization import get_default_qconfig_mapping, quantize_dynamic
+from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+from VGG16 import INPUT_SIZE, VGG16
+
+
+def load_vgg16(
+    checkpoint_path, store_dir, color_map, batch_size=8, classes=None, model_cache=None
+):
+    """
+    Load a checkpoint in counts mode, with the samples of the families it was
+    trained on in the feature store as the validation data. Older checkpoints
+    without their families need classes passed.
+    """
+    checkpoint = torch.load(checkpoint_path, map_location="cpu", mmap=True)
+    classes = checkpoint.get("classes") or classes
+    if classes is None:
+        raise ValueError("The checkpoint has no classes, pass them explicitly.")
+    vgg16 = VGG16(batch_size, 0, "counts", model_cache=model_cache)
+    vgg16.loadData(store_dir, color_map, classes)
+    vgg16.setValidationData()
+    vgg16.loadModel(checkpoint_path)
+    vgg16.network.eval()
+    return vgg16
+
+
+def quantize_static(vgg16, num_batches=8):
+    """
+    Quantize the convolutions and Linear layers to int8, with the activation
+    ranges calibrated on the first num_batches batches of the validation data.
+    The input expansion stays fp32.
+    """
+    torch.backends.quantized.engine = "x86"
+    example = torch.zeros(1, *INPUT_SIZE["image"])
+    model = prepare_fx(
+        copy.deepcopy(vgg16.model).eval(),
+        get_default_qconfig_mapping("x86"),
+        (example,),
+    )
+    with torch.inference_mode():
+        for i, (x, _) in enumerate(vgg16.valid_loader):
+            if i == num_batches:
+                break
+            model(vgg16.input_expansion(x))
+    return torch.nn.Sequential(vgg16.input_expansion, convert_fx(model)).eval()
+
+
+def export_models(vgg16, output_dir, num_calibration_batches=8):
+    """
+    Export the fp32 network and its int8 variants, return their paths.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    network = vgg16.network.cpu().eval()
+    example = torch.zeros(vgg16.batch_size, *INPUT_SIZE["counts"])
+    variants = {
+        "fp32": network,
+        "int8_dynamic": quantize_dynamic(
+            copy.deepcopy(network), {torch.nn.Linear}, dtype=torch.qint8
+        ),
+        "int8_static": quantize_static(vgg16, num_calibration_batches),
+    }
+    paths = {}
+    with torch.inference_mode():
+        for name, model in variants.items():
+            paths[name] = os.path.join(output_dir, f"vgg16_{name}.pt")
+            torch.jit.save(torch.jit.trace(model, example), paths[name])
+    paths["fp32_onnx"] = os.path.join(output_dir, "vgg16_fp32.onnx")
+    # the features are always 7x7 for the 224x224 images, where the adaptive
+    # pooling does nothing, but ONNX cannot export it without static sizes
+    onnx_network = copy.deepcopy(network)
+    onnx_network[1].avgpool = torch.nn.Identity()
+    # newer torch exports with dynamo by default, which needs onnxscript
+    options = {}
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+        options["dynamo"] = False
+    torch.onnx.export(
+        onnx_network,
+        (example,),
+        paths["fp32_onnx"],
+        input_names=["counts"],
+        output_names=["logits"],
+        dynamic_axes={"counts": {0: "batch"}, "logits": {0: "batch"}},
+        opset_version=17,
+        **options,
+    )
+    return paths
+
+
+def load_engine(path):
+    """
+    Load an exported model as a function from a batch of counts to logits.
+    """
+    if path.endswith(".onnx"):
+        import onnxruntime
+
+        session = onnxruntime.InferenceSession(path, providers=["CPUExecutionProvider"])
+        return lambda x: torch.from_numpy(session.run(None, {"counts": x.numpy()})[0])
+    model = torch.jit.load(path).eval()
+    return model
+
+
+def evaluate(engine, loader):
+    """
+    Get the accuracy and the predictions of an engine over a loader.
+    """
+    predictions, targets = [], []
+    with torch.inference_mode():
+        for x, label in loader:
+            predictions.append(engine(x).argmax(dim=1))
+            targets.append(label)
+    predictions, targets = torch.cat(predictions), torch.cat(targets)
+    return (predictions == targets).float().mean().item(), predictions
+
+
+def time_engine(engine, x, repeat):
+    """
+    Get the median run time (sec) of an engine on a batch.
+    """
+    times = []
+    with torch.inference_mode():
+        engine(x)  # warm up
+        for _ in range(repeat):
+            start_time = time.perf_counter()
+            engine(x)
+            times.append(time.perf_counter() - start_time)
+    return float(np.median(times))
+
+
+def benchmark_models(vgg16, paths, repeat=10):
+    """
+    Compare latency, throughput, size and accuracy of the exported models
+    against the fp32 checkpoint.
+    """
+    loader = vgg16.valid_loader
+    batch = next(iter(loader))[0]
+    engines = {"checkpoint": vgg16.network}
+    engines.update({name: load_engine(path) for name, path in paths.items()})
+    baseline, baseline_predictions = evaluate(vgg16.network, loader)
+    print(
+        "%-14s %12s %14s %10s %9s %9s"
+        % ("engine", "latency(ms)", "samples/sec", "size(MiB)", "acc", "agree")
+    )
+    results = {}
+    for name, engine in engines.items():
+        latency = time_engine(engine, batch[:1], repeat)
+        throughput = len(batch) / time_engine(engine, batch, repeat)
+        if name == "checkpoint":
+            size = sum(
+                t.numel() * t.element_size() for t in vgg16.model.state_dict().values()
+            )
+        else:
+            size = os.path.getsize(paths[name])
+        accuracy, predictions = evaluate(engine, loader)
+        # share of the samples classified the same as the checkpoint
+        agreement = (predictions == baseline_predictions).float().mean().item()
+        results[name] = {
+            "latency_ms": latency * 1000,
+            "samples_per_sec": throughput,
+            "size_mib": size / 2**20,
+            "accuracy": accuracy,
+            "accuracy_delta": accuracy - baseline,
+            "agreement": agreement,
+        }
+        print(
+            "%-14s %12.1f %14.1f %10.1f %9.3f %9.3f"
+            % (name, latency * 1000, throughput, size / 2**20, accuracy, agreement)
+        )
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("checkpoint")
+    parser.add_argument("--store", default="features", help="feature store")
+    parser.add_argument("--color-map", default="APIColorMappingRule.json")
+    parser.add_argument("--classes", nargs="+", help="for checkpoints without them")
+    parser.add_argument("--model-cache", help="directory caching the base model")
+    parser.add_argument("--output-dir", default="export")
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--calibration-batches", type=int, default=8)
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--no-benchmark", action="store_true")
+    args = parser.parse_args()
+    vgg16 = load_vgg16(
+        args.checkpoint,
+        args.store,
+        args.color_map,
+        args.batch_size,
+        args.classes,
+        args.model_cache,
+    )
+    paths = export_models(vgg16, args.output_dir, args.calibration_batches)
+    for name, path in paths.items():
+        print(f"{name}: {path}")
+    if not args.no_benchmark:
+        benchmark_models(vgg16, paths, args.repeat)
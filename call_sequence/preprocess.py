@@ -1,10 +1,46 @@
+import multiprocessing
 import os
 import time
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 
+import numpy as np
 from apiCalling import DynamicAnalysis, clear_report_log
-from imageGenerator import ImageGenerator
-from utils import is_Proccessed, load_label_info
+from featureStore import FeatureStore
+from imageGenerator import CATEGORY_ALIASES, ImageGenerator
+from manifest import Manifest, hash_file
+from metrics import metrics
+from utils import find_report, get_report_name, link_file, list_reports, load_label_info
+
+# image generator of a worker process, created once by init_worker
+worker_image_generator = None
+
+
+def init_worker(*args):
+    """
+    Create the image generator of a worker process.
+    """
+    global worker_image_generator
+    worker_image_generator = ImageGenerator(*args)
+
+
+def run_stage(task):
+    """
+    Run an image generation stage on one sample in a worker process.
+
+    Return (file name, result, error, metrics) so one bad sample does not stop
+    the batch. The metrics recorded in a worker process are sent back with the
+    result, in the main process they are already in place.
+    """
+    stage, file_name, kwargs = task
+    try:
+        with metrics.timer("image_sample_seconds", stage=stage):
+            result = getattr(worker_image_generator, stage)(file_name, **kwargs)
+        error = None
+    except Exception as e:
+        result, error = None, f"{type(e).__name__}: {e}"
+    worker_metrics = metrics.drain() if multiprocessing.parent_process() else None
+    return file_name, result, error, worker_metrics
 
 
 class Preprocess:
@@ -23,6 +59,18 @@ class Preprocess:
         request_interval,
         max_wait_time,
         num_of_each_family,
+        max_in_flight=1,
+        history_path=None,
+        report_compression=None,
+        num_workers=1,
+        manifest_path="manifest.sqlite",
+        num_time_bins=16,
+        feature_store=None,
+        sandbox_url="http://localhost:8090",
+        report_store=None,
+        sandbox_nodes=None,
+        max_request_interval=30,
+        submit_delay=1,
     ):
         """
         Initialize the parameters
@@ -43,6 +91,32 @@ class Preprocess:
         self.BASE_TIME = base_time
         self.REQUEST_INTERVAL = request_interval
         self.MAX_WAIT_TIME = max_wait_time
+        # upper bound of the backoff between two status checks
+        self.MAX_REQUEST_INTERVAL = max_request_interval
+        # pause after each submission
+        self.SUBMIT_DELAY = submit_delay
+        # number of samples analyzed by the sandbox at the same time
+        self.MAX_IN_FLIGHT = max_in_flight
+        # past analysis times, used to decide when to check a task first
+        self.HISTORY_PATH = history_path
+        # compression of the saved reports: None, "gzip" or "zstd"
+        self.REPORT_COMPRESSION = report_compression
+        # number of processes generating the images
+        self.NUM_WORKERS = num_workers
+        # record of the completed stages of every sample
+        self.MANIFEST_PATH = manifest_path
+        # number of equal time intervals of the feature array
+        self.NUM_TIME_BINS = num_time_bins
+        # directory packing the feature arrays of all the samples for training
+        self.FEATURE_STORE = feature_store
+        # address of the sandbox API
+        self.SANDBOX_URL = sandbox_url
+        # directory keeping every report under the SHA-256 of its sample, so
+        # identical samples are analyzed once, or None to only use JSON_PATH
+        self.REPORT_STORE = report_store
+        # sandbox hosts sharing the samples, dicts with the "url", "token" and
+        # "limit" of each, or None to only use SANDBOX_URL
+        self.SANDBOX_NODES = sandbox_nodes
         # balance the number of the sample in every family
         self.NUM_OF_EACH_FAMILY = num_of_each_family
         # load data description
@@ -59,88 +133,450 @@ class Preprocess:
         os.makedirs(self.NPY_PATH, exist_ok=True)
         os.makedirs(self.GRAPH_PATH, exist_ok=True)
 
+    def open_manifest(self):
+        """
+        Open the manifest, recording the reports on disk it does not know yet,
+        e.g. copied in, or written just before a crash
+        """
+        manifest = Manifest(self.MANIFEST_PATH)
+        done = set(manifest.get_done("report"))
+        for file_name in set(list_reports(self.JSON_PATH)) - done:
+            manifest.mark_done(file_name, "report")
+        manifest.commit()
+        return manifest
+
     def dynamic_analysis(self):
         """
-        Perform dynamic analysis on the malware samples
+        Perform dynamic analysis on the malware samples, keeping up to
+        MAX_IN_FLIGHT samples in the sandbox at the same time, or up to the
+        limit of each of the SANDBOX_NODES
+
+        Samples are identified by their SHA-256: a sample identical to one
+        already analyzed reuses its report instead of going to the sandbox.
         """
         if self.label_info is None:
             print("Data description was not loaded correctly.")
             return
-        malware_dir_path = os.path.join(self.DATASET_DIR, self.DATA_DESCRIPTION)
+        malware_dir_path = os.path.join(self.DATASET_DIR, self.SAMPLE_FOLDER)
         file_list = os.listdir(malware_dir_path)
-        processed_list = os.listdir(self.JSON_PATH)
-        processed_list = [
-            os.path.splitext(file_name)[0] for file_name in processed_list
-        ]
+        manifest = self.open_manifest()
         processed_count = defaultdict(int)
-        dynamic_analysis = DynamicAnalysis(self.API_TOKEN)
+        dynamic_analysis = DynamicAnalysis(
+            self.API_TOKEN,
+            self.MAX_IN_FLIGHT,
+            self.HISTORY_PATH,
+            self.MAX_REQUEST_INTERVAL,
+            self.REPORT_COMPRESSION,
+            self.SANDBOX_URL,
+            self.SANDBOX_NODES,
+            self.SUBMIT_DELAY,
+        )
+        if self.REPORT_STORE is not None:
+            os.makedirs(self.REPORT_STORE, exist_ok=True)
+        # SHA-256 of the samples in the sandbox, their identical samples
+        # waiting for the report, and the submission time of every sample
+        in_flight = {}
+        waiting = defaultdict(list)
+        submitted = {}
+        # samples of every family in the sandbox or waiting for a report, so
+        # the family limit holds with several samples in flight
+        pending_count = defaultdict(int)
+        num_reused, saved_seconds = 0, 0.0
+        # hash the samples analyzed before they were hashed, e.g. the existing
+        # corpus, so identical new samples reuse their reports whatever the order
         for file in file_list:
-            label = self.label_info.get(file)
-            if not label:
-                print("The file is not recorded in data description.")
-                continue
-            if processed_count[label] > self.NUM_OF_EACH_FAMILY:
-                continue
             file_name = os.path.splitext(file)[0]
-            if is_Proccessed(processed_list, file_name):
-                processed_count[label] += 1
-                continue
-            task_id = dynamic_analysis.get_analysis_report_id(malware_dir_path, file)
-            if task_id < 0:
-                print("The file is not processed successfully.")
+            if not manifest.is_done(file_name, "report"):
                 continue
-            time.sleep(self.BASE_TIME)
-            wait_time_counter = self.BASE_TIME
-            while wait_time_counter < self.MAX_WAIT_TIME:
-                status_code = dynamic_analysis.save_report(
-                    self.JSON_PATH, file_name, task_id
+            if manifest.get_hash(file_name) is None:
+                sha256 = hash_file(os.path.join(malware_dir_path, file))
+                manifest.set_hash(file_name, sha256)
+                self.store_report(file_name, sha256)
+        manifest.commit()
+
+        def reuse_report(file, sha256):
+            nonlocal num_reused, saved_seconds
+            seconds = self.reuse_report(manifest, os.path.splitext(file)[0], sha256)
+            if seconds is None:
+                return False
+            processed_count[self.label_info.get(file)] += 1
+            num_reused += 1
+            saved_seconds += seconds
+            return True
+
+        def pending_samples():
+            # checked lazily, so finished reports count towards the family limit
+            for file in file_list:
+                label = self.label_info.get(file)
+                if not label:
+                    print("The file is not recorded in data description.")
+                    continue
+                if (
+                    processed_count[label] + pending_count[label]
+                    > self.NUM_OF_EACH_FAMILY
+                ):
+                    continue
+                file_name = os.path.splitext(file)[0]
+                if manifest.is_done(file_name, "report"):
+                    processed_count[label] += 1
+                    continue
+                sha256 = hash_file(os.path.join(malware_dir_path, file))
+                manifest.set_hash(file_name, sha256)
+                if reuse_report(file, sha256):
+                    continue
+                # an identical sample is in the sandbox, wait for its report
+                pending_count[label] += 1
+                if sha256 in in_flight:
+                    waiting[sha256].append(file)
+                    continue
+                in_flight[sha256] = file
+                submitted[file] = time.perf_counter()
+                yield file
+
+        start_time = time.perf_counter()
+        num_samples, failures = 0, 0
+        for file, status_code in dynamic_analysis.analyze_concurrently(
+            malware_dir_path,
+            pending_samples(),
+            self.JSON_PATH,
+            self.BASE_TIME,
+            self.REQUEST_INTERVAL,
+            self.MAX_WAIT_TIME,
+            self.label_info,
+        ):
+            num_samples += 1
+            file_name = os.path.splitext(file)[0]
+            sha256 = manifest.get_hash(file_name)
+            del in_flight[sha256]
+            identical = waiting.pop(sha256, [])
+            for sample in [file] + identical:
+                pending_count[self.label_info.get(sample)] -= 1
+            if status_code == 200:
+                processed_count[self.label_info.get(file)] += 1
+                manifest.set_analysis_time(
+                    sha256, time.perf_counter() - submitted[file]
                 )
-                if status_code == 200:
-                    break
-                time.sleep(self.REQUEST_INTERVAL)
-                wait_time_counter += self.REQUEST_INTERVAL
+                self.store_report(file_name, sha256)
+                manifest.mark_done(file_name, "report")
+                manifest.commit()
+                for sample in identical:
+                    reuse_report(sample, sha256)
+            else:
+                failures += 1
+                if identical:
+                    print(
+                        f"{len(identical)} samples identical to {file} "
+                        "left for the next run."
+                    )
+        manifest.close()
+        self.record_stage(
+            "dynamic_analysis", num_samples, failures, time.perf_counter() - start_time
+        )
+        self.record_deduplication(num_reused, saved_seconds)
 
-    def generate_image(self):
+    def find_stored_report(self, manifest, sha256):
         """
-        Generate the image from the dynamic analysis report
+        Find the report of a sample by its SHA-256: in the report store, or
+        the report of an identical sample. Return its path, or None.
         """
-        # extract the feature from the report
-        file_list = os.listdir(self.JSON_PATH)
-        processed_list = os.listdir(self.CSV_PATH)
-        processed_list = [
-            os.path.splitext(file_name)[0] for file_name in processed_list
-        ]
-        image_generator = ImageGenerator(
+        if self.REPORT_STORE is not None:
+            path = find_report(self.REPORT_STORE, sha256)
+            if path is not None:
+                return path
+        for name in manifest.get_names(sha256):
+            if manifest.is_done(name, "report"):
+                path = find_report(self.JSON_PATH, name)
+                if path is not None:
+                    return path
+        return None
+
+    def store_report(self, file_name, sha256):
+        """
+        Add the report of a sample to the report store, under its SHA-256.
+        """
+        if self.REPORT_STORE is None:
+            return
+        path = find_report(self.JSON_PATH, file_name)
+        if path is None:
+            return
+        extension = os.path.basename(path)[len(file_name) :]
+        link_file(path, os.path.join(self.REPORT_STORE, sha256 + extension))
+
+    def reuse_report(self, manifest, file_name, sha256):
+        """
+        Give a sample the report of an identical sample, if there is one.
+
+        Return the sandbox time saved in sec, the recorded analysis time or
+        BASE_TIME if it is unknown, or None if there is no report to reuse.
+        """
+        path = self.find_stored_report(manifest, sha256)
+        if path is None:
+            return None
+        name = os.path.basename(path)
+        extension = name[len(get_report_name(name)) :]
+        link_file(path, os.path.join(self.JSON_PATH, file_name + extension))
+        # keep reports analyzed before the store was set up
+        if self.REPORT_STORE is not None and not find_report(self.REPORT_STORE, sha256):
+            self.store_report(file_name, sha256)
+        manifest.mark_done(file_name, "report")
+        manifest.commit()
+        seconds = manifest.get_analysis_time(sha256)
+        return self.BASE_TIME if seconds is None else seconds
+
+    def record_deduplication(self, num_reused, saved_seconds):
+        """
+        Record and print how many samples reused a report and the sandbox time
+        it saved
+        """
+        metrics.inc("dedup_samples_total", num_reused)
+        metrics.inc("dedup_sandbox_seconds_saved_total", saved_seconds)
+        metrics.log("dedup", samples=num_reused, sandbox_seconds_saved=saved_seconds)
+        metrics.write()
+        print(
+            "Deduplication: %d samples reused a report, saving %.1f(secs) "
+            "(%.2f hours) of sandbox time"
+            % (num_reused, saved_seconds, saved_seconds / 3600)
+        )
+
+    def run_image_stage(self, stage, file_names, manifest, done_stages, **kwargs):
+        """
+        Run an ImageGenerator stage over the samples, in NUM_WORKERS processes
+
+        Samples are handed out in chunks and in sorted order. Failures are
+        reported per sample, the other samples are recorded in the manifest
+        as done with done_stages, a list of (stage, version).
+        """
+        tasks = [(stage, file_name, kwargs) for file_name in sorted(file_names)]
+        initargs = (
             self.JSON_PATH,
             self.CSV_PATH,
             self.NPY_PATH,
             self.GRAPH_PATH,
             self.COLOR_MAP,
+            self.NUM_TIME_BINS,
         )
-        for file in file_list:
-            file_name = os.path.splitext(file)[0]
-            if is_Proccessed(processed_list, file_name):
+        start_time = time.perf_counter()
+        if self.NUM_WORKERS > 1 and len(tasks) > 1:
+            chunksize = max(1, len(tasks) // (self.NUM_WORKERS * 4))
+            with ProcessPoolExecutor(
+                self.NUM_WORKERS, initializer=init_worker, initargs=initargs
+            ) as executor:
+                results = list(executor.map(run_stage, tasks, chunksize=chunksize))
+        else:
+            init_worker(*initargs)
+            results = [run_stage(task) for task in tasks]
+        seconds = time.perf_counter() - start_time
+        failures = 0
+        for file_name, _, e, worker_metrics in results:
+            if worker_metrics is not None:
+                metrics.merge(worker_metrics)
+            if e is not None:
+                print(f"Error in {stage} of {file_name}: {e}")
+                failures += 1
+                continue
+            for done_stage, version in done_stages:
+                manifest.mark_done(file_name, done_stage, version)
+        manifest.commit()
+        if failures:
+            print(f"{failures} of {len(tasks)} samples failed in {stage}.")
+        self.record_stage(stage, len(tasks), failures, seconds)
+        return [(file_name, result, e) for file_name, result, e, _ in results]
+
+    def get_output_path(self, stage, file_name):
+        """
+        Get the file an image stage writes for a sample.
+        """
+        output_dir, extension = {
+            "csv": (self.CSV_PATH, ".csv"),
+            "npy": (self.NPY_PATH, ".npy"),
+            "image": (self.GRAPH_PATH, ".png"),
+        }[stage]
+        return os.path.join(output_dir, file_name + extension)
+
+    def run_deduplicated_stage(
+        self, stage, file_names, manifest, done_stages, required=(), **kwargs
+    ):
+        """
+        Run an image stage like run_image_stage, once per SHA-256.
+
+        A sample identical to one already done with done_stages and required
+        reuses its files, the same for one identical to another sample of
+        this run, once it is done. Samples without a hash are run as usual.
+        """
+        required = list(done_stages) + list(required)
+        to_run, duplicates, sources = [], {}, {}
+        for file_name in sorted(file_names):
+            sha256 = manifest.get_hash(file_name)
+            if sha256 is None:
+                to_run.append(file_name)
+                continue
+            if sha256 not in sources:
+                done = [
+                    name
+                    for name in manifest.get_names(sha256)
+                    if all(manifest.is_done(name, s, v) for s, v in required)
+                ]
+                sources[sha256] = done[0] if done else file_name
+                if not done:
+                    to_run.append(file_name)
+                    continue
+            duplicates[file_name] = sources[sha256]
+        results = self.run_image_stage(stage, to_run, manifest, done_stages, **kwargs)
+        if not duplicates:
+            return results
+        run_results = {file_name: (result, e) for file_name, result, e in results}
+        store = None
+        for file_name, source in sorted(duplicates.items()):
+            result, e = run_results.get(source, (None, None))
+            if source not in run_results and stage == "process_report":
+                # done in an earlier run, the feature array is in the store
+                if self.FEATURE_STORE and store is None:
+                    store = FeatureStore(self.FEATURE_STORE)
+                if store is not None:
+                    result = np.array(store.get_feature_array(source))
+            if e is None:
+                try:
+                    for done_stage, _ in done_stages:
+                        link_file(
+                            self.get_output_path(done_stage, source),
+                            self.get_output_path(done_stage, file_name),
+                        )
+                except OSError as error:
+                    e = f"{type(error).__name__}: {error}"
+            if e is not None:
+                print(f"Error in {stage} of {file_name}, same as {source}: {e}")
+                results.append((file_name, None, e))
                 continue
-            image_generator.extract_feature(file_name)
+            for done_stage, version in done_stages:
+                manifest.mark_done(file_name, done_stage, version)
+            results.append((file_name, result, None))
+        manifest.commit()
+        metrics.inc(
+            "dedup_stage_samples_total",
+            sum(e is None for _, _, e in results[len(to_run) :]),
+            stage=stage,
+        )
+        return results
+
+    def record_stage(self, stage, num_samples, failures, seconds):
+        """
+        Record the duration and throughput of a finished stage
+        """
+        samples_per_sec = num_samples / seconds if seconds > 0 else 0.0
+        metrics.observe("stage_seconds", seconds, stage=stage)
+        metrics.inc("stage_samples_total", num_samples - failures, stage=stage)
+        metrics.inc("stage_failures_total", failures, stage=stage)
+        metrics.set("stage_samples_per_sec", samples_per_sec, stage=stage)
+        metrics.log(
+            "stage",
+            stage=stage,
+            samples=num_samples,
+            failures=failures,
+            seconds=seconds,
+            samples_per_sec=samples_per_sec,
+        )
+        metrics.write()
+
+    def pack_features(self, manifest, feature_arrays, version):
+        """
+        Add the feature arrays, a dict of sample name to array, to the feature
+        store with their labels
+        """
+        start_time = time.perf_counter()
+        store = FeatureStore(self.FEATURE_STORE)
+        labels = {
+            os.path.splitext(file)[0]: label
+            for file, label in (self.label_info or {}).items()
+        }
+        for file_name, feature_array in sorted(feature_arrays.items()):
+            store.add(file_name, labels.get(file_name), feature_array)
+        store.flush()
+        # only recorded once the shard is written
+        for file_name in feature_arrays:
+            manifest.mark_done(file_name, "store", version)
+        manifest.commit()
+        self.record_stage(
+            "store", len(feature_arrays), 0, time.perf_counter() - start_time
+        )
+
+    def generate_image(self, fused=True, keep_intermediate=False):
+        """
+        Generate the image from the dynamic analysis report
+
+        The fused mode goes from each report to its image in memory, and only
+        keeps the csv and npy files with keep_intermediate. Otherwise every
+        stage writes its files and the next one reads them back.
+
+        Stages are skipped by the manifest, and redone when the number of time
+        bins, the category aliases or the color map they were generated with
+        changed. With FEATURE_STORE, the new feature arrays are also packed
+        for training.
+        """
+        manifest = self.open_manifest()
+        aliases = ",".join(f"{a}={c}" for a, c in sorted(CATEGORY_ALIASES.items()))
+        feature_version = f"bins={self.NUM_TIME_BINS};aliases={aliases}"
+        image_version = f"{feature_version};color_map={hash_file(self.COLOR_MAP)}"
+        file_list = manifest.get_done("report")
+        if fused:
+            done_stages = [("image", image_version)]
+            if keep_intermediate:
+                done_stages += [("csv", ""), ("npy", feature_version)]
+            file_list = [
+                file_name
+                for file_name in file_list
+                if not manifest.is_done(file_name, "image", image_version)
+                or self.FEATURE_STORE
+                and not manifest.is_done(file_name, "store", feature_version)
+            ]
+            results = self.run_deduplicated_stage(
+                "process_report",
+                file_list,
+                manifest,
+                done_stages,
+                [("store", feature_version)] if self.FEATURE_STORE else [],
+                keep_intermediate=keep_intermediate,
+            )
+            if self.FEATURE_STORE:
+                feature_arrays = {
+                    file_name: feature_array
+                    for file_name, feature_array, e in results
+                    if e is None
+                }
+                self.pack_features(manifest, feature_arrays, feature_version)
+            manifest.close()
+            return
+        # extract the feature from the report
+        file_list = [
+            file_name
+            for file_name in file_list
+            if not manifest.is_done(file_name, "csv")
+        ]
+        self.run_deduplicated_stage(
+            "extract_feature", file_list, manifest, [("csv", "")]
+        )
         # get feature value of each category
-        file_list = os.listdir(self.CSV_PATH)
-        processed_list = os.listdir(self.NPY_PATH)
-        processed_list = [
-            os.path.splitext(file_name)[0] for file_name in processed_list
+        file_list = [
+            file_name
+            for file_name in manifest.get_done("csv")
+            if not manifest.is_done(file_name, "npy", feature_version)
         ]
-        for file in file_list:
-            file_name = os.path.splitext(file)[0]
-            if is_Proccessed(processed_list, file_name):
-                continue
-            image_generator.generate_vector_array(file_name)
+        self.run_deduplicated_stage(
+            "generate_vector_array", file_list, manifest, [("npy", feature_version)]
+        )
         # generate the image
-        file_list = os.listdir(self.NPY_PATH)
-        processed_list = os.listdir(self.GRAPH_PATH)
-        processed_list = [
-            os.path.splitext(file_name)[0] for file_name in processed_list
+        file_list = [
+            file_name
+            for file_name in manifest.get_done("npy", feature_version)
+            if not manifest.is_done(file_name, "image", image_version)
         ]
-        for file in file_list:
-            file_name = os.path.splitext(file)[0]
-            """if is_Proccessed(processed_list, file_name):
-                continue"""
-            image_generator.generate_image(file_name)
+        self.run_deduplicated_stage(
+            "generate_image", file_list, manifest, [("image", image_version)]
+        )
+        if self.FEATURE_STORE:
+            feature_arrays = {
+                file_name: np.load(os.path.join(self.NPY_PATH, f"{file_name}.npy"))
+                for file_name in manifest.get_done("npy", feature_version)
+                if not manifest.is_done(file_name, "store", feature_version)
+            }
+            self.pack_features(manifest, feature_arrays, feature_version)
+        manifest.close()
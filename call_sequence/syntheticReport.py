@@ -0,0 +1,59 @@
+import random
+
+import ujson
+from utils import open_report
+
+# relative frequency of the call categories in the synthetic reports
+CATEGORY_MIX = {
+    "file": 30,
+    "register": 20,
+    "process": 15,
+    "system": 10,
+    "networking": 8,
+    "thread": 7,
+    "synchronisation": 5,
+    "hash": 3,
+    "reversing": 2,
+}
+
+
+def write_synthetic_report(
+    path, num_calls, calls_per_process=5000, seed=0, category_mix=CATEGORY_MIX
+):
+    """
+    Write a report with num_calls API calls, one process at a time
+    """
+    rng = random.Random(seed)
+    categories = list(category_mix)
+    weights = list(category_mix.values())
+    start_time = 1700000000.0
+    with open_report(path, "wb") as report:
+        report.write(
+            b'{"info": {"id": 1, "duration": 120}, "behavior": {"processes": ['
+        )
+        pid = 0
+        while num_calls > 0:
+            count = min(calls_per_process, num_calls)
+            num_calls -= count
+            calls = [
+                {
+                    "category": category,
+                    "status": 1,
+                    "api": "NtCreateFile",
+                    "return_value": 0,
+                    "arguments": {
+                        "file_handle": "0x00000abc",
+                        "filepath": "C:\\Windows\\System32\\kernel32.dll",
+                        "desired_access": "0x80100080",
+                    },
+                    "time": start_time + rng.uniform(0, 120),
+                    "tid": 1000 + pid,
+                }
+                for category in rng.choices(categories, weights, k=count)
+            ]
+            process = {"pid": 1000 + pid, "process_name": "sample.exe"}
+            process = ujson.dumps(process)[:-1] + ', "calls": '
+            report.write(b", " if pid else b"")
+            report.write(process.encode() + ujson.dumps(calls).encode() + b"}")
+            pid += 1
+        report.write(b'], "summary": {}}}')
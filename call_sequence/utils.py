@@ -1,11 +1,14 @@
-import pandas as pd
+import csv
+import gzip
+import os
+import shutil
 
-
-def is_Proccessed(processed_list, file_name):
-    """
-    Check if the file is processed.
-    """
-    return file_name in processed_list
+# file extension of the saved report for each compression
+REPORT_EXTENSIONS = {
+    None: ".json",
+    "gzip": ".json.gz",
+    "zstd": ".json.zst",
+}
 
 
 def load_label_info(description_path, name_column="name", label_column="label"):
@@ -13,9 +16,8 @@ def load_label_info(description_path, name_column="name", label_column="label"):
     Get a dictionary saving label information.
     """
     try:
-        df = pd.read_csv(description_path)
-        label_info = dict(zip(df[name_column], df[label_column]))
-        return label_info
+        with open(description_path, "r", newline="") as f:
+            return {row[name_column]: row[label_column] for row in csv.DictReader(f)}
     except Exception as e:
         print(f"Error reading CSV file: {e}")
         return None
@@ -27,3 +29,60 @@ def hex_to_rgb(hex_color):
     """
     hex_color = hex_color.lstrip("#")
     return tuple(int(hex_color[i : i + 2], 16) for i in (0, 2, 4))
+
+
+def open_report(path, mode="rb"):
+    """
+    Open a report file, compressing or decompressing it by its extension.
+    """
+    if path.endswith(".gz") or path.endswith(".gz.part"):
+        return gzip.open(path, mode, compresslevel=6)
+    if path.endswith(".zst") or path.endswith(".zst.part"):
+        import zstandard
+
+        return zstandard.open(path, mode)
+    return open(path, mode)
+
+
+def get_report_name(file_name):
+    """
+    Get the sample name of a report file, or None if it is not a report.
+    """
+    for extension in sorted(REPORT_EXTENSIONS.values(), key=len, reverse=True):
+        if file_name.endswith(extension):
+            return file_name[: -len(extension)]
+    return None
+
+
+def list_reports(dir_path):
+    """
+    List the sample names of the reports in a directory.
+    """
+    report_names = [get_report_name(file_name) for file_name in os.listdir(dir_path)]
+    return [file_name for file_name in report_names if file_name is not None]
+
+
+def find_report(dir_path, file_name):
+    """
+    Find the report of a sample, whichever compression it was saved with.
+    """
+    for extension in REPORT_EXTENSIONS.values():
+        path = os.path.join(dir_path, file_name + extension)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def link_file(source, target):
+    """
+    Hard-link a file to a new path, or copy it across file systems, replacing
+    the target if it exists.
+    """
+    temp_path = target + ".part"
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+    try:
+        os.link(source, temp_path)
+    except OSError:
+        shutil.copyfile(source, temp_path)
+    os.replace(temp_path, target)